@@ -1,4 +1,6 @@
 import os
+import shutil
+import tempfile
 from openpyxl import Workbook
 
 #filenames = ["static", "ri", "po", "ph", "pl", "p", "vo", "mv", "mtbv", "af", "up"]
@@ -9,17 +11,21 @@ filenames = ["DPS", "MTBV", "NOSH", "NOSHOU", "PA", "PB", "VO", "WC10010", "WC01
 # Basisordner (kannst du anpassen)
 base_folder = "D:/Datastream/Firmcharacteristics/US"
 
-# 
-for i in range(1, 33, 1):
-    folder_name = f"{i:03d}"  # Format mit führender Null
-    folder_path = os.path.join(base_folder, folder_name)
-    os.makedirs(folder_path, exist_ok=False)
+# Eine leere Excel-Datei einmal erzeugen und danach nur noch kopieren
+with tempfile.TemporaryDirectory() as template_folder:
+    template_path = os.path.join(template_folder, "template.xlsx")
+    Workbook().save(template_path)
 
-    # In jedem Ordner Excel-Dateien erstellen
-    for name in filenames:
-        file_name = f"{name}_{folder_name}.xlsx"
-        file_path = os.path.join(folder_path, file_name)
-        wb = Workbook()
-        wb.save(file_path)
+    for i in range(1, 33, 1):
+        folder_name = f"{i:03d}"  # Format mit führender Null
+        folder_path = os.path.join(base_folder, folder_name)
+        os.makedirs(folder_path, exist_ok=True)
 
-print("All files and folders have been generated.")
\ No newline at end of file
+        # In jedem Ordner Excel-Dateien erstellen, bereits vorhandene Dateien werden nicht überschrieben
+        for name in filenames:
+            file_name = f"{name}_{folder_name}.xlsx"
+            file_path = os.path.join(folder_path, file_name)
+            if not os.path.exists(file_path):
+                shutil.copyfile(template_path, file_path)
+
+print("All files and folders have been generated.")
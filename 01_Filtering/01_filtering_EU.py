@@ -1,15 +1,26 @@
 import os
+import hashlib
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 from tqdm import tqdm
-from filter import DSPreprocess, plot_panel_data
+from filter import DSPreprocess, in_stocks, plot_panel_data, raw_panel_version, read_raw_panel, read_static_xlsx, restore_columns, select_columns, snapshot_key, sort_by_stock_date, stockday_columns
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 
+# the filters select rows without copying them explicitly, with copy-on-write the selections share memory with their input
+pd.set_option("mode.copy_on_write", True)
+
 data_path      = r"/data/Datastream/PriceData/EU"
 save_dir = "Filtered_Data"
 
+start_date = '1994-01-01'
+end_date   = '2025-01-31'
+
 penny_percentile = 0.10
 std_extreme_removal_threshold = 10
 
@@ -20,212 +31,221 @@ except:
 
 nof_subfolders = 44 
 
-timeseries_dfs = []
-static_dfs     = []
+folder_nbrs = [f"{i:03d}" for i in range(1, nof_subfolders + 1)]
+
+# the countries are filtered concurrently in the survivorship and missing value filters
+country_workers = min(8, os.cpu_count())
 
 logging.info("Starting to import data.")
-for i in tqdm(range(1, nof_subfolders + 1), desc="Load data"):
-    folder_nbr       = f"{i:03d}"
-    folder_path      = os.path.join(data_path, folder_nbr)
-    OHLCV_panel_iter = pd.read_feather(os.path.join(data_path, "Panel_Data_EU", f"OHLCV_panel_{folder_nbr}.feather"))
-    static_iter      = pd.read_excel(os.path.join(folder_path, f'static_{folder_nbr}.xlsx'), engine='openpyxl')
-    timeseries_dfs.append(OHLCV_panel_iter)
-    static_dfs.append(static_iter)
+# the static files are independent, read them concurrently
+with ThreadPoolExecutor(max_workers=min(8, nof_subfolders)) as executor:
+    static_paths = [os.path.join(data_path, folder_nbr, f'static_{folder_nbr}.xlsx') for folder_nbr in folder_nbrs]
+    static_dfs   = list(tqdm(executor.map(read_static_xlsx, static_paths), total=nof_subfolders, desc="Load data"))
 
 statics = pd.concat(static_dfs, axis=0, ignore_index=True)
-statics.reset_index(drop=True, inplace=True)
 
 ########################################################################################################################
 ## Define datatypes:
 ########################################################################################################################
-delist_str = statics["ENAME"].str.extract(r"DELIST\.(\d{2}/\d{2}/\d{2})")[0]
-statics["Delisting Date"] = pd.to_datetime(delist_str, format="%d/%m/%y", errors="coerce")
-
 statics['BDATE'] = pd.to_datetime(statics['BDATE'])
 string_columns = ['DSCD', 'ENAME', 'EXMNEM', 'GEOGN', 'ISIN', 'ISINID', 'LOC', 'PCUR', 'TRAC', 'TYPE', 'CURRENCY']
 if 'Type' in statics.columns:
     string_columns.insert(0, 'Type')
 
 statics[string_columns] = statics[string_columns].astype(str)
+# company names are only scanned by the Arrow string kernels (delisting notes and name patterns), keeping them in an
+# Arrow backed column hands the same buffers to every scan instead of converting the Python strings each time
+statics['ENAME'] = statics['ENAME'].astype("string[pyarrow]")
+
+# one RE2 scan over the Arrow array of company names, names without delisting note give missing values
+delist_str = pc.struct_field(
+    pc.extract_regex(pa.array(statics["ENAME"]), pattern=r"DELIST\.(?P<date>\d{2}/\d{2}/\d{2})"), "date"
+).to_pandas()
+statics["Delisting Date"] = pd.to_datetime(delist_str, format="%d/%m/%y", errors="coerce")
 
 logging.info("Creating full OHLC panel dataframe.")
-OHLCV_panel = pd.concat(timeseries_dfs, axis=0, ignore_index=True)
-OHLCV_panel.sort_values(by=["Date", "Stock"], inplace=True)
-OHLCV_panel.reset_index(drop=True, inplace=True)
+# the panel data sets of all subfolders are hive partitions "folder=<folder_nbr>" of one feather dataset
+panel_dataset = ds.dataset(
+    os.path.join(data_path, "Panel_Data_EU"),
+    format="feather",
+    partitioning=ds.partitioning(pa.schema([("folder", pa.string())]), flavor="hive"),
+)
+panel_filter = ds.field("folder").isin(folder_nbrs) & (ds.field("Date") <= pd.Timestamp(end_date))
+# the first return of a stock in the sample is computed from the ReturnIndex of its own last observation up to start_date.
+# The scan skips the days before the earliest of these last observations, only the Stock and Date columns are read to find
+# it. Later days up to start_date only serve as base of a return as well and are dropped with the out-of-sample rows
+pre_sample = panel_dataset.to_table(columns=["Stock", "Date"], filter=panel_filter & (ds.field("Date") <= pd.Timestamp(start_date)))
+first_date = pc.min(pre_sample.unify_dictionaries().group_by("Stock").aggregate([("Date", "max")])["Date_max"]).as_py()
+del pre_sample
+if first_date is not None:
+    panel_filter &= ds.field("Date") >= first_date
 
-OHLCV_panel = OHLCV_panel.drop_duplicates(subset=["Stock", "Date"], keep="first")
+# the concatenated, sorted and de-duplicated panel is cached, the key changes with the sample period, the selected shards and their
+# modification times and the version of the steps building the cached panel
+shard_files = sorted(fragment.path for fragment in panel_dataset.get_fragments(filter=panel_filter))
+cache_key   = hashlib.sha1("".join([f"raw_panel_v{raw_panel_version}", start_date, end_date] + [f"{path}:{os.path.getmtime(path)}" for path in shard_files]).encode()).hexdigest()[:16]
+cache_path  = os.path.join(data_path, f"panel_raw_{cache_key}.feather")
 
-OHLCV_panel.loc[:, 'Stock'] = OHLCV_panel['Stock'].astype(str)
-OHLCV_panel.loc[:, 'Stock'] = OHLCV_panel['Stock'].str.strip()
-statics.loc[:, 'DSCD']      = statics['DSCD'].str.strip()
+# the panel and statics before the parameter dependent filters (18) and later are cached as well, the key changes with
+# the raw panel, the static files, filter.py and the part of this script up to filter (18)
+pipeline_key   = snapshot_key(__file__, cache_key, static_paths)
+snapshot_paths = {name: os.path.join(data_path, f"pre_param_{pipeline_key}_{name}.feather") for name in ["panel", "statics"]}
 
-mask = OHLCV_panel["ReturnIndex"] < 1e-6
-mask.sum()
+if all(os.path.exists(path) for path in snapshot_paths.values()):
+    logging.info(f"Loading cached panel and statics before filter (18) {snapshot_paths['panel']}.")
+    OHLCV_panel = pd.read_feather(snapshot_paths["panel"])
+    statics     = pd.read_feather(snapshot_paths["statics"])
+else:
+    if os.path.exists(cache_path):
+        logging.info(f"Loading cached panel {cache_path}.")
+        OHLCV_panel = pd.read_feather(cache_path)
+    else:
+        OHLCV_panel = read_raw_panel(panel_dataset, panel_filter)
+        OHLCV_panel.to_feather(cache_path, compression="zstd", compression_level=3)
 
-OHLCV_panel.loc[mask, "ReturnIndex"] = np.nan
+    statics['DSCD']      = pc.utf8_trim_whitespace(pa.array(statics['DSCD'])).to_numpy(zero_copy_only=False)
 
-OHLCV_panel["Return"] = (
-    OHLCV_panel.groupby("Stock")["ReturnIndex"]
-    .transform(lambda x: x / x.shift(1) - 1)
-)
+    # Drop unknown country codes:
+    statics = statics[statics['GEOGN'].notna() & (statics['GEOGN'] != 'nan')  & (statics['GEOGN'] != 'UNITED STATES')]
+    # Guernsey -> Checked manually. (Sancus Lending Group). Relabelled before GEOGN becomes a categorical without that category
+    statics.loc[statics["GEOGN"] == "GUERNSEY", "GEOGN"] = "UNITED KINGDOM"
 
-########################################################################################################################
-## Filter data:
-########################################################################################################################
-## Generic filters
-########################################################################################################################
-OHLCV_panel = OHLCV_panel[OHLCV_panel['Date'] <= '2025-01-31']
-OHLCV_panel = OHLCV_panel[OHLCV_panel['Date'] > '1994-01-01']
+    # stock codes, countries, security types and currencies become categoricals, stock codes of panel and statics share one dtype
+    OHLCV_panel, statics = DSPreprocess.prepare(OHLCV_panel, statics)
 
+    # the column is modified on a plain NumPy copy, with copy-on-write the array behind the frame is read-only
+    return_index = OHLCV_panel["ReturnIndex"].to_numpy(copy=True)
+    return_index[return_index < 1e-6] = np.nan
+    OHLCV_panel["ReturnIndex"] = return_index
 
-# Filter (11) - Already done in beginning:
-# Remove stocks where RI is unavailable.
-# -> This is already done in AttProj1_ProcessRawData
+    # previous RI of the same stock via the built-in grouped shift, no Python call per stock
+    OHLCV_panel["Return"] = OHLCV_panel["ReturnIndex"] / OHLCV_panel.groupby("Stock", observed=True)["ReturnIndex"].shift(1) - 1
 
-# Drop unknown country codes:
-statics = statics[statics['GEOGN'].notna() & (statics['GEOGN'] != 'nan')  & (statics['GEOGN'] != 'UNITED STATES')]
-# Guernsey -> Checked manually. (Sancus Lending Group).
-statics.loc[statics["GEOGN"] == "GUERNSEY", "GEOGN"] = "UNITED KINGDOM"
+    ########################################################################################################################
+    ## Filter data:
+    ########################################################################################################################
+    ## Generic filters
+    ########################################################################################################################
+    # The panel is read from before start_date until end_date, the days up to start_date only serve as base of the first returns.
+    # They are dropped together with the stocks removed by filters (1) to (5), so the panel rows are selected only once.
+    in_sample = (OHLCV_panel['Date'] > start_date).to_numpy()
 
-########################################################################################################################
-## Filter data:
-########################################################################################################################
-## Generic filters
-########################################################################################################################
-OHLCV_panel = OHLCV_panel[OHLCV_panel['Date'] <= '2025-01-31']
-OHLCV_panel = OHLCV_panel[OHLCV_panel['Date'] > '1994-01-01']
 
+    # Filter (11) - Already done in beginning:
+    # Remove stocks where RI is unavailable.
+    # -> This is already done in AttProj1_ProcessRawData
 
-# Filter (11) - Already done in beginning:
-# Remove stocks where RI is unavailable.
-# -> This is already done in AttProj1_ProcessRawData
+    ########################################################################################################################
+    ## Filters based on static data
+    ########################################################################################################################
+    # Filters (1) to (5) are applied to the stocks of the panel, see DSPreprocess.panel_stocks
+    panel_stocks = DSPreprocess.panel_stocks(OHLCV_panel, in_sample)
 
-# Drop unknown country codes:
-statics = statics[statics['GEOGN'].notna() & (statics['GEOGN'] != 'nan')  & (statics['GEOGN'] != 'UNITED STATES')]
-# Guernsey -> Checked manually. (Sancus Lending Group).
-statics.loc[statics["GEOGN"] == "GUERNSEY", "GEOGN"] = "UNITED KINGDOM"
+    # Filter (1) - Equity filter:
+    panel_stocks = DSPreprocess.apply_per_country(DSPreprocess.filter_non_common_stocks, panel_stocks, statics)
 
-########################################################################################################################
-## Filters based on static data
-########################################################################################################################
-# Filter (1) - Equity filter:
-panels_temp = [
-    DSPreprocess.filter_non_common_stocks(
-        OHLCV_panel[OHLCV_panel['Stock'].isin(statics.loc[statics['GEOGN'] == country, 'DSCD'])], statics, country=country)
-    for country in statics['GEOGN'].unique()
-]
-OHLCV_panel = pd.concat(panels_temp, ignore_index=True)
 
+    # Filter (2) - Cross-listing filter:
+    panel_stocks = DSPreprocess.apply_per_country(DSPreprocess.filter_cross_listings, panel_stocks, statics)
 
-# Filter (2) - Cross-listing filter:
-panels_temp = [
-    DSPreprocess.filter_cross_listings(
-        OHLCV_panel[OHLCV_panel['Stock'].isin(statics.loc[statics['GEOGN'] == country, 'DSCD'])], statics, country=country)
-    for country in statics['GEOGN'].unique()
-]
-OHLCV_panel = pd.concat(panels_temp, ignore_index=True)
 
+    # Filter (3): Duplicate LOC Codes
+    panel_stocks = DSPreprocess.filter_duplicate_loc_codes(panel_stocks, statics)
 
-# Filter (3): Duplicate LOC Codes
-OHLCV_panel = DSPreprocess.filter_duplicate_loc_codes(OHLCV_panel, statics)
 
+    # Filter (4) - Foreign firms:
+    panel_stocks = panel_stocks[in_stocks(panel_stocks['Stock'], statics['DSCD'].unique())]
 
-# Filter (4) - Foreign firms:
-OHLCV_panel = OHLCV_panel[OHLCV_panel.Stock.isin(statics.DSCD.unique())]
 
+    # Filter (5) - Stocks in foreign currencies:
+    panel_stocks = DSPreprocess.apply_per_country(DSPreprocess.filter_foreign_currency_stocks, panel_stocks, statics)
 
-# Filter (5) - Stocks in foreign currencies:
-panels_temp = [
-    DSPreprocess.filter_foreign_currency_stocks(
-        OHLCV_panel[OHLCV_panel['Stock'].isin(statics.loc[statics['GEOGN'] == country, 'DSCD'])], statics, country=country)
-    for country in statics['GEOGN'].unique()
-]
+    OHLCV_panel = OHLCV_panel[in_sample & in_stocks(OHLCV_panel['Stock'], panel_stocks['Stock'])]
 
-OHLCV_panel = pd.concat(panels_temp, ignore_index=True)
 
+    # Filter (17) - Survivorship bias:
+    OHLCV_panel = DSPreprocess.apply_per_country(DSPreprocess.filter_surivorship_bias, OHLCV_panel, statics, max_workers=country_workers)
 
-# Filter (17) - Survivorship bias:
-panels_temp = [
-    DSPreprocess.filter_surivorship_bias(
-        OHLCV_panel[OHLCV_panel['Stock'].isin(statics.loc[statics['GEOGN'] == country, 'DSCD'])], statics, country=country)
-    for country in statics['GEOGN'].unique()
-]
 
-OHLCV_panel = pd.concat(panels_temp, ignore_index=True)
+    # The per-stock filters below work on the panel in (Stock, Date) order and keep that order, the panel is sorted once here.
+    # They only read the stockday_columns, the other columns are taken along once for the remaining rows before filling missings.
+    full_panel  = sort_by_stock_date(OHLCV_panel)
+    OHLCV_panel = select_columns(full_panel, stockday_columns)
 
 
-########################################################################################################################
-## Filters based on ReturnIndex
-########################################################################################################################
-# Filter (7) - :
-# Remove stocks of which more than 98% of non-zero mean returns are either positive or negative
-OHLCV_panel = DSPreprocess.filter_implausible_returns(OHLCV_panel)
+    ########################################################################################################################
+    ## Filters based on ReturnIndex
+    ########################################################################################################################
+    # Filter (7) - :
+    # Remove stocks of which more than 98% of non-zero mean returns are either positive or negative
+    OHLCV_panel = DSPreprocess.filter_implausible_returns(OHLCV_panel)
 
 
-########################################################################################################################
-## Stockday filters:
-########################################################################################################################
-# Filter (13):
-# If RI is forward filled for 10 consecutive days, then remove those days.
-OHLCV_panel = DSPreprocess.filter_padded_values_delistings(OHLCV_panel, statics)
+    ########################################################################################################################
+    ## Stockday filters:
+    ########################################################################################################################
+    # Filter (13):
+    # If RI is forward filled for 10 consecutive days, then remove those days.
+    OHLCV_panel = DSPreprocess.filter_padded_values_delistings(OHLCV_panel, statics)
+
 
+    # Filter (8):
+    # Remove stocks for which the returns are zero in more than 95% of their sample (After applying filter (13)).
+    OHLCV_panel = DSPreprocess.filter_zero_return_stocks(OHLCV_panel)
 
-# Filter (8):
-# Remove stocks for which the returns are zero in more than 95% of their sample (After applying filter (13)).
-OHLCV_panel = DSPreprocess.filter_zero_return_stocks(OHLCV_panel)
 
+    # Filter (14):
+    # Stale prices
+    OHLCV_panel = DSPreprocess.filter_stale_prices(OHLCV_panel)
 
-# Filter (14):
-# Stale prices
-OHLCV_panel = DSPreprocess.filter_stale_prices(OHLCV_panel)
 
+    # Filter (9) and (10), computed together:
+    # Remove stocks with a daily standard deviation of more than 40%.
+    # Remove stocks with a daily standard deviation of less than 0.01 bps.
+    OHLCV_panel = DSPreprocess.filter_stocks_by_volatility(OHLCV_panel, volatility_threshold=0.40)
 
-# Filter (9):
-# Remove stocks with a daily standard deviation of more than 40%.
-OHLCV_panel  = DSPreprocess.filter_stocks_by_high_volatility(OHLCV_panel, volatility_threshold=0.40)
 
+    # Filter (15):
+    # Target filter rate not reported / ~0.0015% (~0.00569% when applied on raw panel) actual filter rate
+    OHLCV_panel = DSPreprocess.filter_outlier_errors(OHLCV_panel, up_ts=1.0, down_ts=-0.5, method='drop')
 
-# Filter (10):
-# Remove stocks with a daily standard deviation of less than 0.01 bps.
-OHLCV_panel = DSPreprocess.filter_stocks_by_low_volatility(OHLCV_panel)
 
+    # Filter (16):
+    # Holiday filter: Has to be applied after filter (11) and (13)!
+    # Remove days on which non-missing or non-zero returns account for less than 0.5% of total available stocks.
+    OHLCV_panel = DSPreprocess.filter_holidays(OHLCV_panel)
 
-# Filter (15):
-# Target filter rate not reported / ~0.0015% (~0.00569% when applied on raw panel) actual filter rate
-OHLCV_panel = DSPreprocess.filter_outlier_errors(OHLCV_panel, up_ts=1.0, down_ts=-0.5, method='drop')
 
+    # Filter (Own - implausible OHLC):
+    # Nonsense values (Low > (Open OR High OR Close) and High < (Open OR Low OR Close):
+    OHLCV_panel = DSPreprocess.filter_implausible_prices(OHLCV_panel)
 
-# Filter (16):
-# Holiday filter: Has to be applied after filter (11) and (13)!
-# Remove days on which non-missing or non-zero returns account for less than 0.5% of total available stocks.
-OHLCV_panel = DSPreprocess.filter_holidays(OHLCV_panel)
 
+    # Filter (Extreme prices - Schmidt, von Arx (2011))
+    # Remove prices higher than 1mio US$.
+    # OHLCV_panel = DSPreprocess.filter_extreme_prices(OHLCV_panel, ts=1_000_000)
 
-# Filter (Own - implausible OHLC):
-# Nonsense values (Low > (Open OR High OR Close) and High < (Open OR Low OR Close):
-OHLCV_panel = DSPreprocess.filter_implausible_prices(OHLCV_panel)
 
+    # NOT NEEDED - Filter (20 - Extreme returns due to decimal errors - Annaert et al. (2013) JBF)
+    # OHLCV_panel = DSPreprocess.filter_decimal_errors(OHLCV_panel, up_ts=4.0, down_ts=-0.85)
 
-# Filter (Extreme prices - Schmidt, von Arx (2011))
-# Remove prices higher than 1mio US$.
-# OHLCV_panel = DSPreprocess.filter_extreme_prices(OHLCV_panel, ts=1_000_000)
 
+    # Filter (No trading activity - Chaieb et al. (2021) JoFE)
+    OHLCV_panel = DSPreprocess.filter_no_trading_activity(OHLCV_panel)
 
-# NOT NEEDED - Filter (20 - Extreme returns due to decimal errors - Annaert et al. (2013) JBF)
-# OHLCV_panel = DSPreprocess.filter_decimal_errors(OHLCV_panel, up_ts=4.0, down_ts=-0.85)
 
+    OHLCV_panel = restore_columns(OHLCV_panel, full_panel)
+    del full_panel
 
-# Filter (No trading activity - Chaieb et al. (2021) JoFE)
-OHLCV_panel = DSPreprocess.filter_no_trading_activity(OHLCV_panel)
 
+    # Filter (Own - NA filter) - Drop all rows before they are populated for the first time and apply forward + backward fill.
+    OHLCV_panel = DSPreprocess.apply_per_country(DSPreprocess.handle_missings, OHLCV_panel, statics, max_workers=country_workers)
 
-# Filter (Own - NA filter) - Drop all rows before they are populated for the first time and apply forward + backward fill.
-panels_temp = [
-    DSPreprocess.handle_missings(
-        OHLCV_panel[OHLCV_panel['Stock'].isin(statics.loc[statics['GEOGN'] == country, 'DSCD'])], statics, country=country)
-    for country in statics['GEOGN'].unique()
-]
-OHLCV_panel = pd.concat(panels_temp, ignore_index=True)
+    # the snapshot is written and reused with a fresh index, row order and values are unchanged
+    OHLCV_panel = OHLCV_panel.reset_index(drop=True)
+    statics     = statics.reset_index(drop=True)
+    OHLCV_panel.to_feather(snapshot_paths["panel"], compression="zstd", compression_level=3)
+    statics.to_feather(snapshot_paths["statics"], compression="zstd", compression_level=3)
 
 
 # Filter (18) - Adjustment inconsistencies.
@@ -250,15 +270,15 @@ OHLCV_panel_temp = DSPreprocess.filter_extreme_returns2(OHLCV_panel_temp, n_std=
 # Filter (12) - Filters the panel to include only stocks with sufficient observation history
 OHLCV_panel_temp = DSPreprocess.filter_short_history_stocks(OHLCV_panel_temp, threshold=120)
 
-OHLCV_panel.replace([np.inf, -np.inf], np.nan, inplace=True)
-OHLCV_panel_final = OHLCV_panel.dropna(subset=['Return'])
+# rows with a finite return and plain stock codes
+OHLCV_panel_final = DSPreprocess.final_panel(OHLCV_panel)
 
 
 # extract companies which are in the final filtered data set
-statics_for_filtered = statics[statics.DSCD.isin(OHLCV_panel_final.Stock.unique().tolist())]
+statics_for_filtered = statics[in_stocks(statics['DSCD'], OHLCV_panel_final['Stock'].unique())]
 
 # save
 logging.info("Saving data and static information for remaining companies.")
-OHLCV_panel_final.to_feather(os.path.join(data_path, save_dir, f"Financial_base_data_panel_filtered_{penny_percentile}_{std_extreme_removal_threshold}.feather"))
+OHLCV_panel_final.to_feather(os.path.join(data_path, save_dir, f"Financial_base_data_panel_filtered_{penny_percentile}_{std_extreme_removal_threshold}.feather"), compression="zstd", compression_level=3)
 statics_for_filtered.to_csv(os.path.join(data_path, save_dir, f"statics_filtered_{penny_percentile}_{std_extreme_removal_threshold}.csv"), index = False)
 
@@ -1,12 +1,20 @@
 import os
+import hashlib
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 from tqdm import tqdm
-from filter import DSPreprocess
+from filter import DSPreprocess, in_stocks, raw_panel_version, read_raw_panel, read_static_xlsx, restore_columns, select_columns, snapshot_key, sort_by_stock_date, stockday_columns
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 
+# the filters select rows without copying them explicitly, with copy-on-write the selections share memory with their input
+pd.set_option("mode.copy_on_write", True)
+
 data_path      = r"/data/Datastream/PriceData/US"
 save_dir = "Filtered_Data"
 
@@ -20,22 +28,14 @@ except:
 
 nof_subfolders = 32 
 
-timeseries_dfs = []
-static_dfs     = []
+folder_nbrs = [f"{i:03d}" for i in range(1, nof_subfolders + 1)]
 
-for i in tqdm(range(1, nof_subfolders + 1), desc="Load data"):
-    folder_nbr       = f"{i:03d}"
-    folder_path      = os.path.join(data_path, folder_nbr)
-    OHLCV_panel_iter = pd.read_feather(os.path.join(data_path, "Panel_Data_US", f"OHLCV_panel_{folder_nbr}.feather"))
-    static_iter      = pd.read_excel(os.path.join(folder_path, f'static_{folder_nbr}.xlsx'), engine='openpyxl')
-    timeseries_dfs.append(OHLCV_panel_iter)
-    static_dfs.append(static_iter)
+# the static files are independent, read them concurrently
+with ThreadPoolExecutor(max_workers=min(8, nof_subfolders)) as executor:
+    static_paths = [os.path.join(data_path, folder_nbr, f'static_{folder_nbr}.xlsx') for folder_nbr in folder_nbrs]
+    static_dfs   = list(tqdm(executor.map(read_static_xlsx, static_paths), total=nof_subfolders, desc="Load data"))
 
 statics = pd.concat(static_dfs, axis=0, ignore_index=True)
-statics.reset_index(drop=True, inplace=True)
-
-delist_str = statics["ENAME"].str.extract(r"DELIST\.(\d{2}/\d{2}/\d{2})")[0]
-statics["Delisting Date"] = pd.to_datetime(delist_str, format="%d/%m/%y", errors="coerce")
 
 statics['BDATE'] = pd.to_datetime(statics['BDATE'])
 string_columns = ['DSCD', 'ENAME', 'EXMNEM', 'GEOGN', 'ISIN', 'ISINID', 'LOC', 'PCUR', 'TRAC', 'TYPE', 'CURRENCY']
@@ -43,162 +43,216 @@ if 'Type' in statics.columns:
     string_columns.insert(0, 'Type')
 
 statics[string_columns] = statics[string_columns].astype(str)
+# company names are only scanned by the Arrow string kernels (delisting notes and name patterns), keeping them in an
+# Arrow backed column hands the same buffers to every scan instead of converting the Python strings each time
+statics['ENAME'] = statics['ENAME'].astype("string[pyarrow]")
+
+# one RE2 scan over the Arrow array of company names, names without delisting note give missing values
+delist_str = pc.struct_field(
+    pc.extract_regex(pa.array(statics["ENAME"]), pattern=r"DELIST\.(?P<date>\d{2}/\d{2}/\d{2})"), "date"
+).to_pandas()
+statics["Delisting Date"] = pd.to_datetime(delist_str, format="%d/%m/%y", errors="coerce")
 
-OHLCV_panel = pd.concat(timeseries_dfs, axis=0, ignore_index=True)
-OHLCV_panel.sort_values(by=["Date", "Stock"], inplace=True)
-OHLCV_panel.reset_index(drop=True, inplace=True)
+# the panel data sets of all subfolders are hive partitions "folder=<folder_nbr>" of one feather dataset
+panel_dataset = ds.dataset(
+    os.path.join(data_path, "Panel_Data_US"),
+    format="feather",
+    partitioning=ds.partitioning(pa.schema([("folder", pa.string())]), flavor="hive"),
+)
+folder_filter = ds.field("folder").isin(folder_nbrs)
 
-logging.info(f"Number of rows before removing duplicate Stock-Date observations: {OHLCV_panel.shape[0]}")
-OHLCV_panel = OHLCV_panel.drop_duplicates(subset=["Stock", "Date"], keep="first")
-logging.info(f"Number of rows after removing duplicate Stock-Date observations: {OHLCV_panel.shape[0]}")
+# the concatenated, sorted and de-duplicated panel is cached, the key changes with the selected shards and their modification times
+# and the version of the steps building the cached panel
+shard_files = sorted(fragment.path for fragment in panel_dataset.get_fragments(filter=folder_filter))
+cache_key   = hashlib.sha1("".join([f"raw_panel_v{raw_panel_version}"] + [f"{path}:{os.path.getmtime(path)}" for path in shard_files]).encode()).hexdigest()[:16]
+cache_path  = os.path.join(data_path, f"panel_raw_{cache_key}.feather")
 
-OHLCV_panel.loc[:, 'Stock'] = OHLCV_panel['Stock'].astype(str)
-OHLCV_panel.loc[:, 'Stock'] = OHLCV_panel['Stock'].str.strip()
-statics.loc[:, 'DSCD']      = statics['DSCD'].str.strip()
+# the panel and statics before the parameter dependent filters (18) and later are cached as well, the key changes with
+# the raw panel, the static files, filter.py and the part of this script up to filter (18)
+pipeline_key   = snapshot_key(__file__, cache_key, static_paths)
+snapshot_paths = {name: os.path.join(data_path, f"pre_param_{pipeline_key}_{name}.feather") for name in ["panel", "statics"]}
 
-mask = OHLCV_panel["ReturnIndex"] < 1e-6
-logging.info(f"Frequency of ReturnIndex observations with extreme small values: {mask.sum()/OHLCV_panel.shape[0]:.6f}")
+if all(os.path.exists(path) for path in snapshot_paths.values()):
+    logging.info(f"Loading cached panel and statics before filter (18) {snapshot_paths['panel']}.")
+    OHLCV_panel = pd.read_feather(snapshot_paths["panel"])
+    statics     = pd.read_feather(snapshot_paths["statics"])
+else:
+    if os.path.exists(cache_path):
+        logging.info(f"Loading cached panel {cache_path}.")
+        OHLCV_panel = pd.read_feather(cache_path)
+    else:
+        OHLCV_panel = read_raw_panel(panel_dataset, folder_filter)
+        OHLCV_panel.to_feather(cache_path, compression="zstd", compression_level=3)
 
-OHLCV_panel.loc[mask, "ReturnIndex"] = np.nan
+    statics['DSCD']      = pc.utf8_trim_whitespace(pa.array(statics['DSCD'])).to_numpy(zero_copy_only=False)
+
+    # stock codes, countries, security types and currencies become categoricals, stock codes of panel and statics share one dtype
+    OHLCV_panel, statics = DSPreprocess.prepare(OHLCV_panel, statics)
+
+    # the column is modified on a plain NumPy copy, with copy-on-write the array behind the frame is read-only
+    return_index = OHLCV_panel["ReturnIndex"].to_numpy(copy=True)
+    mask = return_index < 1e-6
+    logging.info(f"Frequency of ReturnIndex observations with extreme small values: {mask.sum()/OHLCV_panel.shape[0]:.6f}")
+
+    return_index[mask] = np.nan
+    OHLCV_panel["ReturnIndex"] = return_index
+
+    # previous RI of the same stock via the built-in grouped shift, no Python call per stock
+    OHLCV_panel["Return"] = OHLCV_panel["ReturnIndex"] / OHLCV_panel.groupby("Stock", observed=True)["ReturnIndex"].shift(1) - 1
+
+    logging.info(f"Number of companies before removing non-regional companies: {statics.shape[0]}")
+    statics = statics[statics['GEOGN'] == 'UNITED STATES']
+    logging.info(f"Number of companies after removing non-regional companies: {statics.shape[0]}")
+
+    ########################################################################################################################
+    ## Filters based on static data
+    ########################################################################################################################
+    # Filters (1) to (5) are applied to the stocks of the panel, see DSPreprocess.panel_stocks
+    panel_stocks = DSPreprocess.panel_stocks(OHLCV_panel)
+
+    # Filter (1) - Equity filter:
+    panel_stocks = DSPreprocess.filter_non_common_stocks(panel_stocks, statics, country='UNITED STATES')
+
+
+    # Filter (2) - Cross-listing filter:
+    panel_stocks = DSPreprocess.filter_cross_listings(panel_stocks, statics, country='UNITED STATES')
 
-OHLCV_panel["Return"] = (
-    OHLCV_panel.groupby("Stock")["ReturnIndex"]
-    .transform(lambda x: x / x.shift(1) - 1)
-)
 
-logging.info(f"Number of companies before removing non-regional companies: {statics.shape[0]}")
-statics = statics[statics['GEOGN'] == 'UNITED STATES']
-logging.info(f"Number of companies after removing non-regional companies: {statics.shape[0]}")
+    # Filter (3): Duplicate LOC Codes
+    panel_stocks = DSPreprocess.filter_duplicate_loc_codes(panel_stocks, statics)
 
-########################################################################################################################
-## Filters based on static data
-########################################################################################################################
-# Filter (1) - Equity filter:
-OHLCV_panel = DSPreprocess.filter_non_common_stocks(OHLCV_panel, statics, country='UNITED STATES')
 
+    # Filter (4) - Foreign firms:
+    panel_stocks = panel_stocks[in_stocks(panel_stocks['Stock'], statics['DSCD'].unique())]
 
-# Filter (2) - Cross-listing filter:
-OHLCV_panel = DSPreprocess.filter_cross_listings(OHLCV_panel, statics, country='UNITED STATES')
 
+    # Filter (5) - Stocks in foreign currencies:
+    panel_stocks = DSPreprocess.filter_foreign_currency_stocks(panel_stocks, statics, country='UNITED STATES')
 
-# Filter (3): Duplicate LOC Codes
-OHLCV_panel = DSPreprocess.filter_duplicate_loc_codes(OHLCV_panel, statics)
+    OHLCV_panel = OHLCV_panel[in_stocks(OHLCV_panel['Stock'], panel_stocks['Stock'])]
 
 
-# Filter (4) - Foreign firms:
-OHLCV_panel = OHLCV_panel[OHLCV_panel.Stock.isin(statics.DSCD.unique())]
+    # Filter (17) - Survivorship bias (obsolete for US data, because our dataset starts in 1993):
+    # OHLCV_panel = DSPreprocess.filter_surivorship_bias(OHLCV_panel, statics, country='UNITED STATES')
 
 
-# Filter (5) - Stocks in foreign currencies:
-OHLCV_panel = DSPreprocess.filter_foreign_currency_stocks(OHLCV_panel, statics, country='UNITED STATES')
+    # The per-stock filters below work on the panel in (Stock, Date) order and keep that order, the panel is sorted once here.
+    # They only read the stockday_columns, the other columns are taken along once for the remaining rows before filling missings.
+    full_panel  = sort_by_stock_date(OHLCV_panel)
+    OHLCV_panel = select_columns(full_panel, stockday_columns)
 
 
-# Filter (17) - Survivorship bias (obsolete for US data, because our dataset starts in 1993):
-# OHLCV_panel = DSPreprocess.filter_surivorship_bias(OHLCV_panel, statics, country='UNITED STATES')
+    ########################################################################################################################
+    ## Filters based on ReturnIndex
+    ########################################################################################################################
+    # Filter (7) - :
+    # Remove stocks of which more than 98% of non-zero mean returns are either positive or negative
+    OHLCV_panel = DSPreprocess.filter_implausible_returns(OHLCV_panel)
 
+    ########################################################################################################################
+    ## Stockday filters:
+    ########################################################################################################################
+    # Filter (13):
+    # If RI is forward filled for 10 consecutive days, then remove those days.
+    OHLCV_panel = DSPreprocess.filter_padded_values_delistings(OHLCV_panel, statics)
 
-########################################################################################################################
-## Filters based on ReturnIndex
-########################################################################################################################
-# Filter (7) - :
-# Remove stocks of which more than 98% of non-zero mean returns are either positive or negative
-OHLCV_panel = DSPreprocess.filter_implausible_returns(OHLCV_panel)
 
-########################################################################################################################
-## Stockday filters:
-########################################################################################################################
-# Filter (13):
-# If RI is forward filled for 10 consecutive days, then remove those days.
-OHLCV_panel = DSPreprocess.filter_padded_values_delistings(OHLCV_panel, statics)
+    # Filter (8):
+    # Remove stocks for which the returns are zero in more than 95% of their sample (After applying filter (13).
+    OHLCV_panel = DSPreprocess.filter_zero_return_stocks(OHLCV_panel)
 
 
-# Filter (8):
-# Remove stocks for which the returns are zero in more than 95% of their sample (After applying filter (13).
-OHLCV_panel = DSPreprocess.filter_zero_return_stocks(OHLCV_panel)
+    # Filter (14):
+    # Stale prices
+    OHLCV_panel = DSPreprocess.filter_stale_prices(OHLCV_panel)
 
 
-# Filter (14):
-# Stale prices
-OHLCV_panel = DSPreprocess.filter_stale_prices(OHLCV_panel)
+    # Filter (9) and (10), computed together:
+    # Remove stocks with a daily standard deviation of more than 40%.
+    # Remove stocks with a daily standard deviation of less than 0.01 bps.
+    OHLCV_panel = DSPreprocess.filter_stocks_by_volatility(OHLCV_panel, volatility_threshold=0.40)
 
 
-# Filter (9):
-# Remove stocks with a daily standard deviation of more than 40%.
-OHLCV_panel  = DSPreprocess.filter_stocks_by_high_volatility(OHLCV_panel, volatility_threshold=0.40)
+    # Filter (15):
+    # Target filter rate not reported / ~0.0015% (~0.00569% when applied on raw panel) actual filter rate
+    OHLCV_panel = DSPreprocess.filter_outlier_errors(OHLCV_panel, up_ts=1.0, down_ts=-0.5, method='drop')
 
 
-# Filter (10):
-# Remove stocks with a daily standard deviation of less than 0.01 bps.
-OHLCV_panel = DSPreprocess.filter_stocks_by_low_volatility(OHLCV_panel)
+    # Filter (16):
+    # Holiday filter: Has to be applied after filter (11) and (13)!
+    # Remove days on which non-missing or non-zero returns account for less than 0.5% of total available stocks.
+    OHLCV_panel = DSPreprocess.filter_holidays(OHLCV_panel)
 
 
-# Filter (15):
-# Target filter rate not reported / ~0.0015% (~0.00569% when applied on raw panel) actual filter rate
-OHLCV_panel = DSPreprocess.filter_outlier_errors(OHLCV_panel, up_ts=1.0, down_ts=-0.5, method='drop')
+    # Filter (Own - implausible OHLC):
+    # Nonsense values (Low > (Open OR High OR Close) and High < (Open OR Low OR Close):
+    OHLCV_panel = DSPreprocess.filter_implausible_prices(OHLCV_panel)
 
 
-# Filter (16):
-# Holiday filter: Has to be applied after filter (11) and (13)!
-# Remove days on which non-missing or non-zero returns account for less than 0.5% of total available stocks.
-OHLCV_panel = DSPreprocess.filter_holidays(OHLCV_panel)
+    # Filter (Extreme prices - Schmidt, von Arx (2011))
+    # Remove prices higher than 1mio US$.
+    # OHLCV_panel = DSPreprocess.filter_extreme_prices(OHLCV_panel, ts=1_000_000)
 
 
-# Filter (Own - implausible OHLC):
-# Nonsense values (Low > (Open OR High OR Close) and High < (Open OR Low OR Close):
-OHLCV_panel = DSPreprocess.filter_implausible_prices(OHLCV_panel)
+    # NOT NEEDED - Filter (20 - Extreme returns due to decimal errors - Annaert et al. (2013) JBF)
+    # OHLCV_panel = DSPreprocess.filter_decimal_errors(OHLCV_panel, up_ts=4.0, down_ts=-0.85)
 
 
-# Filter (Extreme prices - Schmidt, von Arx (2011))
-# Remove prices higher than 1mio US$.
-# OHLCV_panel = DSPreprocess.filter_extreme_prices(OHLCV_panel, ts=1_000_000)
+    # Filter (No trading activity - Chaieb et al. (2021) JoFE)
+    OHLCV_panel = DSPreprocess.filter_no_trading_activity(OHLCV_panel)
 
+    #
+    # # Filter (Own - Extreme returns)
+    # # OHLCV_panel = DSPreprocess.filter_extreme_returns(OHLCV_panel, lower=0.00, upper=0.999)
+    # OHLCV_panel = DSPreprocess.filter_extreme_returns2(OHLCV_panel, n_std=5) # Less aggressive than above version.
 
-# NOT NEEDED - Filter (20 - Extreme returns due to decimal errors - Annaert et al. (2013) JBF)
-# OHLCV_panel = DSPreprocess.filter_decimal_errors(OHLCV_panel, up_ts=4.0, down_ts=-0.85)
 
+    OHLCV_panel = restore_columns(OHLCV_panel, full_panel)
+    del full_panel
 
-# Filter (No trading activity - Chaieb et al. (2021) JoFE)
-OHLCV_panel = DSPreprocess.filter_no_trading_activity(OHLCV_panel)
 
-#
-# # Filter (Own - Extreme returns)
-# # OHLCV_panel = DSPreprocess.filter_extreme_returns(OHLCV_panel, lower=0.00, upper=0.999)
-# OHLCV_panel = DSPreprocess.filter_extreme_returns2(OHLCV_panel, n_std=5) # Less aggressive than above version.
+    # Filter (Own - NA filter) - Drop all rows before they are populated for the first time and apply forward + backward fill.
+    OHLCV_panel = DSPreprocess.handle_missings(OHLCV_panel, statics, country='UNITED STATES')
 
 
-# Filter (Own - NA filter) - Drop all rows before they are populated for the first time and apply forward + backward fill.
-OHLCV_panel = DSPreprocess.handle_missings(OHLCV_panel, statics, country='UNITED STATES')
+    ########################################################################################################################
+    # Manual removal of implausibilities:
+    ########################################################################################################################
+    # The removals are collected first and applied with a single mask below.
+    # 1.) AgEagle Aerial Systems, Inc. (680683). Remove observations before foundation date.
+    removed_before = {"680683": "2010-01-01"}
 
 
-########################################################################################################################
-# Manual removal of implausibilities:
-########################################################################################################################
-# 1.) AgEagle Aerial Systems, Inc. (680683). Remove observations before foundation date.
-OHLCV_panel = OHLCV_panel[~((OHLCV_panel['Stock'] == "680683") & (OHLCV_panel['Date'] < '2010-01-01'))]
+    # 2.) Strange prices due to stock splits / reverse splits
+    removed_stocks     = ["872328"]
+    removed_stock_days = [("9364PF", "2020-07-13"), ("50259R", "2018-01-04"), ("67684T", "2023-08-07"), ("2566DU", "2024-06-04"),
+                          ("28355P", "2008-12-17"), ("2634G3", "2024-03-27"), ("32650J", "2009-05-07")]
 
 
-# 2.) Strange prices due to stock splits / reverse splits
-OHLCV_panel = OHLCV_panel[~(OHLCV_panel["Stock"]  == "872328")]
-OHLCV_panel = OHLCV_panel[~((OHLCV_panel["Stock"] == "9364PF") & (OHLCV_panel["Date"] == "2020-07-13"))]
-OHLCV_panel = OHLCV_panel[~((OHLCV_panel["Stock"] == "50259R") & (OHLCV_panel["Date"] == "2018-01-04"))]
-OHLCV_panel = OHLCV_panel[~((OHLCV_panel["Stock"] == "67684T") & (OHLCV_panel["Date"] == "2023-08-07"))]
-OHLCV_panel = OHLCV_panel[~((OHLCV_panel["Stock"] == "2566DU") & (OHLCV_panel["Date"] == "2024-06-04"))]
-OHLCV_panel = OHLCV_panel[~((OHLCV_panel["Stock"] == "28355P") & (OHLCV_panel["Date"] == "2008-12-17"))]
-OHLCV_panel = OHLCV_panel[~((OHLCV_panel["Stock"] == "2634G3") & (OHLCV_panel["Date"] == "2024-03-27"))]
-OHLCV_panel = OHLCV_panel[~((OHLCV_panel["Stock"] == "32650J") & (OHLCV_panel["Date"] == "2009-05-07"))]
+    # 3.) Implausible returns due to high amount of missings:
+    removed_stocks += ["7076TJ", "7076TK"]
 
 
-# 3.) Implausible returns due to high amount of missings:
-OHLCV_panel = OHLCV_panel[~(OHLCV_panel["Stock"] == "7076TJ")]
-OHLCV_panel = OHLCV_panel[~(OHLCV_panel["Stock"] == "7076TK")]
+    # 4.) Seems to be some sort of dividend split, that was incorrectly labeled as a stock:
+    removed_stocks += ["92238K"]
 
 
-# 4.) Seems to be some sort of dividend split, that was incorrectly labeled as a stock:
-OHLCV_panel = OHLCV_panel[~(OHLCV_panel["Stock"] == "92238K")]
+    # 5.) Delete day with unusual drop in listed firms:
+    # OHLCV_panel = OHLCV_panel[~(OHLCV_panel["Date"] == '1995-05-26')]
 
+    # the stock comparisons work on the categorical codes, no (Stock, Date) tuples are built for the few removed stock-days
+    removed = in_stocks(OHLCV_panel["Stock"], removed_stocks)
+    for stock, date in removed_stock_days:
+        removed |= ((OHLCV_panel["Stock"] == stock) & (OHLCV_panel["Date"] == date)).to_numpy()
+    for stock, first_date in removed_before.items():
+        removed |= ((OHLCV_panel["Stock"] == stock) & (OHLCV_panel["Date"] < first_date)).to_numpy()
+    OHLCV_panel = OHLCV_panel[~removed]
 
-# 5.) Delete day with unusual drop in listed firms:
-# OHLCV_panel = OHLCV_panel[~(OHLCV_panel["Date"] == '1995-05-26')]
+    # the snapshot is written and reused with a fresh index, row order and values are unchanged
+    OHLCV_panel = OHLCV_panel.reset_index(drop=True)
+    statics     = statics.reset_index(drop=True)
+    OHLCV_panel.to_feather(snapshot_paths["panel"], compression="zstd", compression_level=3)
+    statics.to_feather(snapshot_paths["statics"], compression="zstd", compression_level=3)
 
 # Filter (18) - Adjustment inconsistencies.
 OHLCV_panel_temp = DSPreprocess.filter_adjustment_inconsistencies(OHLCV_panel, threshold=0.05)
@@ -218,13 +272,13 @@ OHLCV_panel = DSPreprocess.filter_extreme_returns2(OHLCV_panel, n_std=10) # Less
 OHLCV_panel = DSPreprocess.filter_short_history_stocks(OHLCV_panel, threshold=120)
 
 
-OHLCV_panel.replace([np.inf, -np.inf], np.nan, inplace=True)
-OHLCV_panel_final = OHLCV_panel.dropna(subset=['Return'])
+# rows with a finite return and plain stock codes
+OHLCV_panel_final = DSPreprocess.final_panel(OHLCV_panel)
 
 # extract companies which are in the final filtered data set
-statics_for_filtered = statics[statics.DSCD.isin(OHLCV_panel_final.Stock.unique().tolist())]
+statics_for_filtered = statics[in_stocks(statics['DSCD'], OHLCV_panel_final['Stock'].unique())]
 
 # save
 logging.info("Saving data and static information for remaining companies.")
-OHLCV_panel_final.to_feather(os.path.join(data_path, save_dir, f"Financial_base_data_panel_filtered_{penny_percentile}_{std_extreme_removal_threshold}.feather"))
+OHLCV_panel_final.to_feather(os.path.join(data_path, save_dir, f"Financial_base_data_panel_filtered_{penny_percentile}_{std_extreme_removal_threshold}.feather"), compression="zstd", compression_level=3)
 statics_for_filtered.to_csv(os.path.join(data_path, save_dir, f"statics_filtered_{penny_percentile}_{std_extreme_removal_threshold}.csv"), index = False)
\ No newline at end of file
@@ -1,22 +1,38 @@
 import re
+import os
+import hashlib
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import matplotlib.pylab as plt
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit, prange
 
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
 
+# the Rust based calamine reader is much faster than openpyxl, which remains as fallback if python-calamine is not installed
+try:
+    import python_calamine
+    excel_engine = 'calamine'
+except ImportError:
+    excel_engine = 'openpyxl'
+
 
 ########################################################################################################################
 ## Helper functions:
 ########################################################################################################################
 def plot_panel_data(panel):
-    panel_vis   = panel.copy()
-
-    grouped          = panel_vis.groupby('Date')
-    unique_firms     = grouped['Stock'].nunique()
-    daily_mean_ret   = grouped['Return'].mean()
-    daily_mcap       = grouped['MarketCAP'].mean() * 1_000_000
+    # one grouping of the dates for all three daily series, the panel is only read
+    daily = panel.groupby('Date', observed=True).agg(
+        firms=('Stock', 'nunique'),
+        ret=('Return', 'mean'),
+        mcap=('MarketCAP', 'mean'),
+    )
+    unique_firms      = daily['firms']
+    daily_mean_ret    = daily['ret']
+    daily_mcap        = daily['mcap'] * 1_000_000
     cumulative_return = (1 + daily_mean_ret).cumprod() - 1
 
     fig, ax = plt.subplots(3, 1, figsize=(10, 12), sharex=False)
@@ -43,8 +59,1068 @@ def plot_panel_data(panel):
     plt.tight_layout()
     plt.show()
 
-class DSPreprocess:
+def read_static_xlsx(path):
+    """
+    Imports a static Datastream xlsx file. The data is cached as feather file next to the xlsx file and reused as long as the xlsx file is not newer.
+    """
+    cache_path = os.path.splitext(path)[0] + ".feather"
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        statics = pd.read_feather(cache_path)
+
+        # missing text cells come back as None, read_excel returns them as NaN
+        object_columns          = statics.columns[statics.dtypes == object]
+        statics[object_columns] = statics[object_columns].where(statics[object_columns].notna(), np.nan)
+        return statics
+
+    statics = pd.read_excel(path, engine=excel_engine)
+
+    # feather needs one type per column, text columns with mixed cell types (e.g. numeric codes or dates) are stored as text, missings stay missing
+    object_columns          = statics.columns[statics.dtypes == object]
+    statics[object_columns] = statics[object_columns].apply(lambda column: column.where(column.isna(), column.astype(str)))
+
+    statics.to_feather(cache_path, compression="zstd")
+    return statics
+
+# prices, volume and firm characteristics are kept in single precision, ReturnIndex and Return stay float64 because the
+# zero-return and low-volatility filters (std below 1e-6) compare returns at a resolution close to float32 rounding
+float32_columns = ['Open', 'High', 'Low', 'Close', 'Volume', 'MarketCAP', 'MTBV', 'AdjFactor', 'UnadjClose']
+
+# version of read_raw_panel, part of the key of the raw panel cached by the filtering scripts. Increase it whenever
+# read_raw_panel changes, panel_raw_*.feather files written by an earlier version are then not reused.
+raw_panel_version = 1
+
+def read_raw_panel(panel_dataset, row_filter):
+    """
+    Reads the rows of the panel dataset selected by row_filter as one frame: sorted by date and stock, without duplicate
+    stock-date observations, with the stock codes trimmed and the float32_columns in single precision.
+    """
+    # one Arrow table for all shards, converted once; self_destruct frees the Arrow buffers column by column during conversion
+    panel = panel_dataset.to_table(filter=row_filter).drop_columns("folder").to_pandas(split_blocks=True, self_destruct=True)
+    # stock codes stay dictionary encoded, with sorted categories the sort below orders them like the strings
+    panel["Stock"] = sorted_stock_categories(panel["Stock"])
+    # panels written before the raw import switched to single precision still come as float64
+    panel = panel.astype({column: np.float32 for column in float32_columns})
+    panel = panel.sort_values(by=["Date", "Stock"], kind="stable", ignore_index=True)
+
+    logging.info(f"Number of rows before removing duplicate Stock-Date observations: {panel.shape[0]}")
+    panel = panel.drop_duplicates(subset=["Stock", "Date"], keep="first", ignore_index=True)
+    logging.info(f"Number of rows after removing duplicate Stock-Date observations: {panel.shape[0]}")
+
+    # whitespace is trimmed on the distinct stock codes only
+    panel["Stock"] = sorted_stock_categories(panel["Stock"], trim_whitespace=True)
+    return panel
+
+def snapshot_key(script_path, cache_key, input_paths):
+    """
+    Returns the key of the panel and statics cached before filter (18). It changes with the raw panel cache key, the modification
+    times of input_paths, this file and the part of the script up to its "# Filter (18)" heading at the start of a line, i.e.
+    with every filter up to filter (17) and its arguments. A script without that heading is hashed as a whole.
+    """
+    with open(script_path) as script_file:
+        script_source = script_file.read()
+    heading     = re.search(r"^# Filter \(18\)", script_source, re.M)
+    script_head = script_source[:heading.start()] if heading else script_source
+    with open(os.path.abspath(__file__)) as filter_file:
+        filter_source = filter_file.read()
+    return hashlib.sha1("".join([cache_key, filter_source, script_head] + [f"{path}:{os.path.getmtime(path)}" for path in input_paths]).encode()).hexdigest()[:16]
+
+def contains_pattern(names, pattern):
+    """
+    Flags the names that contain a match of the regex pattern. The names are scanned once by the RE2 automaton of Arrow,
+    which runs in linear time for the long alternations of literal name patterns. Missing names are not flagged.
+    """
+    matches = pc.match_substring_regex(pa.array(names, type=pa.string()), pattern).fill_null(False)
+    return pd.Series(matches.to_numpy(zero_copy_only=False), index=names.index)
+
+def contains_literals(names, literals):
+    """
+    Flags the names that contain one of the literal substrings. Each literal is searched by the plain substring kernel of Arrow,
+    which skips the regex engine and beats one long alternation for short literal lists. Missing names are not flagged.
+    """
+    name_array = pa.array(names, type=pa.string())
+    matches    = np.zeros(len(names), dtype=bool)
+    for literal in literals:
+        matches |= pc.match_substring(name_array, literal).fill_null(False).to_numpy(zero_copy_only=False)
+    return pd.Series(matches, index=names.index)
+
+def in_stocks(stock_column, stocks):
+    """
+    Flags the rows of a stock code column whose stock is one of stocks (a semi-join on the stock codes). For the shared categorical
+    stock dtype the flags are gathered from a lookup table over the category codes, so the panel rows are not hashed.
+    """
+    if not isinstance(stock_column.dtype, pd.CategoricalDtype):
+        return stock_column.isin(stocks).to_numpy()
+
+    categories = stock_column.cat.categories
+    positions  = categories.get_indexer(np.asarray(stocks))
+    # one slot per category plus a last one that stays False, missing stocks have code -1
+    selected   = np.zeros(len(categories) + 1, dtype=bool)
+    selected[positions[positions >= 0]] = True
+    return selected[stock_column.cat.codes.to_numpy()]
+
+def sorted_stock_categories(stocks, trim_whitespace=False):
+    """
+    Returns the stock codes as categorical with sorted categories, so that sorting by the codes sorts by the strings. Only the
+    distinct codes are converted (and trimmed by the Arrow kernel if trim_whitespace), codes equal after trimming are merged
+    into one category. The rows keep their integer codes, no Python string is created per row.
+    """
+    stocks     = stocks.astype("category")
+    categories = stocks.cat.categories.astype(str)
+    if trim_whitespace:
+        categories = pc.utf8_trim_whitespace(pa.array(categories, type=pa.string())).to_numpy(zero_copy_only=False)
+    categories, positions = np.unique(np.asarray(categories, dtype=object), return_inverse=True)
+    codes = stocks.cat.codes.to_numpy()
+    return pd.Series(pd.Categorical.from_codes(np.where(codes >= 0, positions[codes], -1), categories), index=stocks.index, name=stocks.name)
+
+def is_sorted_by_stock_date(panel):
+    """
+    Checks in one pass over the key columns whether a panel is sorted by stock (category order for categorical stock codes)
+    and by date within each stock.
+    """
+    if isinstance(panel["Stock"].dtype, pd.CategoricalDtype):
+        stock_codes = panel["Stock"].cat.codes.to_numpy()
+    else:
+        stock_codes = pd.factorize(panel["Stock"], sort=True)[0]
+    dates      = panel["Date"].to_numpy()
+    same_stock = stock_codes[1:] == stock_codes[:-1]
+    return bool(np.all(stock_codes[1:] >= stock_codes[:-1]) and np.all(~same_stock | (dates[1:] >= dates[:-1])))
+
+def sort_by_stock_date(panel):
+    """
+    Returns the panel sorted by stock and date, which is the row order the per-stock filters work on. The scripts sort the
+    panel once before these filters and every filter keeps the order, so a sorted panel is returned as it is instead of
+    being sorted again.
+    """
+    if is_sorted_by_stock_date(panel):
+        return panel
+    return panel.sort_values(["Stock", "Date"], kind="stable")
+
+def stock_bounds(panel):
+    """
+    Returns the start positions of the stocks of a panel that is sorted by stock, with the panel length appended.
+    """
+    new_stock = panel["Stock"].ne(panel["Stock"].shift()).to_numpy()
+    return np.append(np.flatnonzero(new_stock), len(panel))
+
+# columns read by the stock-day filters (7) to (16) and the OHLC and no trading filters
+stockday_columns = ["Stock", "Date", "Open", "High", "Low", "Close", "Volume", "ReturnIndex", "Return"]
+
+def select_columns(panel, columns):
+    """
+    Returns the given columns of the panel with the row positions in a 'Row' column. A chain of row filters run on this frame
+    only copies these columns whenever it drops rows, restore_columns takes the other columns along once at the end.
+    """
+    return panel[columns].assign(Row=np.arange(panel.shape[0]))
+
+def restore_columns(panel, full_panel):
+    """
+    Adds the columns of full_panel missing in a frame from select_columns for its remaining rows, in the column order of
+    full_panel followed by the columns the filters added, and drops the 'Row' column.
+    """
+    rows    = panel["Row"].to_numpy()
+    missing = [column for column in full_panel.columns if column not in panel.columns]
+    columns = list(full_panel.columns) + [column for column in panel.columns if column not in full_panel.columns and column != "Row"]
+    return pd.concat([panel, full_panel[missing].take(rows).set_axis(panel.index)], axis=1)[columns]
+
+def stock_groups(panel):
+    """
+    Returns the stock codes of the rows (numbered in order of appearance), the row positions grouped by stock and the bounds
+    of the stocks in these positions. Within a stock the rows keep their order, a panel with contiguous stocks is not sorted.
+    """
+    stock_codes = pd.factorize(panel["Stock"])[0]
+    if np.all(stock_codes[1:] >= stock_codes[:-1]):
+        order = np.arange(stock_codes.size)
+    else:
+        order = np.argsort(stock_codes, kind="stable")
+    bounds = np.searchsorted(stock_codes[order], np.arange(stock_codes.max(initial=-1) + 2))
+    return stock_codes, order, bounds
+
+@njit(parallel=True, cache=True)
+def stock_return_stats(returns, order, bounds):
+    """
+    Reduces the returns of every stock in one pass: the numbers of observed, positive, negative and zero returns (columns
+    of counts) and the standard deviation with one degree of freedom, missing for fewer than two observed returns. The std
+    is accumulated with the same running mean updates as the grouped std of pandas, in the row order of the stock. The returns
+    are visited through order and the stocks are delimited by bounds, see stock_groups, and processed in parallel.
+    """
+    n_stocks = bounds.size - 1
+    counts   = np.zeros((n_stocks, 4), dtype=np.int64)
+    std      = np.full(n_stocks, np.nan)
+    for k in prange(n_stocks):
+        n_observed, n_positive, n_negative, n_zero = 0, 0, 0, 0
+        mean, sum_squares = 0.0, 0.0
+        for i in range(bounds[k], bounds[k + 1]):
+            ret = returns[order[i]]
+            if np.isnan(ret):
+                continue
+            n_observed += 1
+            if ret > 0.0:
+                n_positive += 1
+            elif ret < 0.0:
+                n_negative += 1
+            else:
+                n_zero += 1
+            old_mean     = mean
+            mean        += (ret - old_mean) / n_observed
+            sum_squares += (ret - mean) * (ret - old_mean)
+        counts[k, 0], counts[k, 1], counts[k, 2], counts[k, 3] = n_observed, n_positive, n_negative, n_zero
+        if n_observed > 1:
+            std[k] = np.sqrt(sum_squares / (n_observed - 1))
+    return counts, std
+
+@njit(parallel=True, cache=True)
+def stale_price_mask(prices, order, bounds, max_run):
+    """
+    Marks the observations of each stock that continue a run of more than max_run identical prices. The prices are visited
+    through order, the row positions sorted by stock and date with the stocks delimited by bounds, and the mask is returned
+    in the row order of prices, so neither the prices nor the mask are copied into sorted order. Works for any column
+    with staleness of the same kind, missing values never continue a run.
+    """
+    keep = np.ones(prices.size, dtype=np.bool_)
+    for k in prange(bounds.size - 1):
+        if bounds[k + 1] - bounds[k] <= max_run:
+            continue  # no run can be longer than the stock
+        current_run = 1
+        previous    = prices[order[bounds[k]]]
+        for i in range(bounds[k] + 1, bounds[k + 1]):
+            price = prices[order[i]]
+            if price == previous:
+                current_run += 1
+            else:
+                current_run = 1
+            previous = price
+            if current_run > max_run:
+                keep[order[i]] = False
+    return keep
+
+@njit(parallel=True, cache=True)
+def delisting_mask(dates, returns, delist_dates, bounds, no_date):
+    """
+    Marks the observations of each stock after its delisting date and the zero or missing returns padded directly before it.
+    """
+    keep = np.ones(dates.size, dtype=np.bool_)
+    for k in prange(bounds.size - 1):
+        start, stop = bounds[k], bounds[k + 1]
+        delist_date = delist_dates[start]
+        if delist_date == no_date:
+            continue
+
+        last = start
+        while last < stop and dates[last] <= delist_date:
+            last += 1
+        while last > start and (returns[last - 1] == 0 or np.isnan(returns[last - 1])):
+            last -= 1
+        keep[last:stop] = False
+    return keep
+
+@njit(parallel=True, cache=True)
+def outlier_mask(returns, bounds, up_ts, down_ts):
+    """
+    Marks both days of each return above up_ts followed by one below down_ts, or vice versa, on the next day of the same
+    stock. The stocks are delimited by bounds and processed in parallel, one range of consecutive stocks per thread.
+    """
+    flagged = np.zeros(returns.size, dtype=np.bool_)
+    for k in prange(bounds.size - 1):
+        for i in range(bounds[k], bounds[k + 1] - 1):
+            ret, next_ret = returns[i], returns[i + 1]
+            if (ret > up_ts and next_ret < down_ts) or (ret < down_ts and next_ret > up_ts):
+                flagged[i]     = True
+                flagged[i + 1] = True
+    return flagged
+
+@njit(parallel=True, cache=True)
+def repeated_quotes_mask(high, low, volume, bounds):
+    """
+    Marks the observations whose high, low and volume all equal those of the previous day of the same stock. Missing values
+    never equal the previous day. The stocks are delimited by bounds and processed in parallel.
+    """
+    repeated = np.zeros(high.size, dtype=np.bool_)
+    for k in prange(bounds.size - 1):
+        for i in range(bounds[k] + 1, bounds[k + 1]):
+            repeated[i] = high[i] == high[i - 1] and low[i] == low[i - 1] and volume[i] == volume[i - 1]
+    return repeated
+
+@njit(nogil=True, cache=True)
+def first_complete_mask(dates, values, bounds):
+    """
+    Marks the observations of each stock on or after the first date on which all values are observed. Stocks without
+    such a date are not marked at all. Runs without the GIL, so that apply_per_country can process countries in threads.
+    """
+    keep = np.zeros(dates.size, dtype=np.bool_)
+    for k in range(bounds.size - 1):
+        start, stop = bounds[k], bounds[k + 1]
+        found, first_date = False, dates[start]
+        for i in range(start, stop):
+            complete = True
+            for j in range(values.shape[1]):
+                if np.isnan(values[i, j]):
+                    complete = False
+                    break
+            if complete and (not found or dates[i] < first_date):
+                found, first_date = True, dates[i]
+        if found:
+            for i in range(start, stop):
+                keep[i] = dates[i] >= first_date
+    return keep
+
+@njit(nogil=True, cache=True)
+def fill_missings(values, bounds, backward):
+    """
+    Forward fills the missing values of each stock in place and, if backward, then backward fills the values still missing.
+    """
+    for k in range(bounds.size - 1):
+        start, stop = bounds[k], bounds[k + 1]
+        for j in range(values.shape[1]):
+            for i in range(start + 1, stop):
+                if np.isnan(values[i, j]):
+                    values[i, j] = values[i - 1, j]
+            if backward:
+                for i in range(stop - 2, start - 1, -1):
+                    if np.isnan(values[i, j]):
+                        values[i, j] = values[i + 1, j]
+
+########################################################################################################################
+## Name patterns:
+########################################################################################################################
+# name patterns of non-common equity per country, see filter (1)
+equity_identifers = {
+    'UNITED STATES':
+    [" TRUST ", " REPR ", " RIGHT", " SERIES ", " NV ", " IV TST",
+    "REAL ESTATE INVESTMENT", "REALTY ", " RLTY", "ROYALTY INVESTMENT",
+    "ASSET INVESTMENT", "CAPITAL INVESTMENT", "ASSET MANAGEMENT",
+    "CAPITAL MANAGEMENT", "INVESTMENT MANAGEMENT", "VENTURE CAPITAL",
+    "FINANCIAL SHBI", "PROPERTY INVESTORS", "INCOME PROPERTY", " UNITS ",
+    " UNIT ", "LIMITED PARTENERSHIP", "FUND ", "EQUITY PARTNERS",
+    "LIMITED VOTING", "SUB VOTING", "TIER ONE SUB", "VARIABLE VOTING",
+    "NON VOTINGREIT ", " RESIDENTIAL", "R E I T", "BENEFICIAL",
+    "BENEFICIARY", "BENEFIT INTEREST", "BEN INTEREST", "SH BEN INT ",
+    "WARRANT", "WRTS", " L P ", "L P INTEREST", "LP UT", "HOLDINGS LP",
+    "PARTENERS UNIT", "PART INT", "UNIT PARTENERSHIP", "UNIT LIMITED",
+    " MORTGAGE", " REAL ESTATE", "CERTIFICATE", "NO PAR VALUE",
+    "HOLDING UNIT", " BACKED", " ST MIN", " CORTS ", " TORPS ", " TOPRS ",
+    "SECURITIES TRUPS", " QUIPS ", "STRATS HIGH YIELD", "TOTAL RETURN",
+    "DIVERSIFIED HOLDINGS", "(SICAV)", "DEPOSITARY", "DEPOSITOR",
+    " RECEIPT", "REP & SHARES", " GLOBAL SHARES", " ADR ", " GDR", "EXPD.",
+    "EXPIRED", "DUPLICATE", "CONVERTIBLE", "CNVRT.", "CONVRT.", "EXCH.",
+    "DEBANTURE", "(DEB)", "NIL PAID", "STRUCTURED ASSET", " CALLABLE",
+    "FLOATING RATE", " ADJUSTABLE", "REDEEMABLE", " PAIRED CTF",
+    "CONSOLIDATED", "INSURED", "CAPITAL SHARES", "DEBT STRATEGIES",
+    "LIQUIDATING", "LIQUID UNIT", "L UNIT", "- LASD", "ACQUISITION",
+    "CAP UNIT", "INCOME UNIT", "PREFERRED"],
+
+    'CANADA': 
+    ["SUBSCRIPTION RIGHTS", "FUND SHARES", "INVESTMENT TRUST", "UNIT", "EXPD", 
+    "PROPERTY TRUST", "N L", "NL", "INCOME TRUST UNITS", "INCOME COMMERCE", 
+    "EXPIRY", "NL ORDINARY", "COMMERCE PAR", "DEFERRED", "EXPIRED", "CDN", 
+    "INCOME FUND", "SUBSCRIPTION RECEIPTS", "RECEIPT", "RIGHTS", "SUB VOTING", 
+    "TRUST UNIT", "MBS TRUST", "BOND FUND", "PARTNERSHIP UNIT", "PARTNER UNIT", 
+    "REIT", "FUND UNITS", "LOAN FUND", "RIGHTS", "CONVERTIBLE FUND", 
+    "PREFERENCE SHARES", "COMBINED UNITS", '"IDS" UNITS', "SPLIT", "REDEEMABLE", 
+    "DIVIDEND FUND", "TOTAL RETURN", "DEBENTURE", "WARRANT", "CREDIT FUND", 
+    "ETF", "STAPLE", "INDEX NOTES", "TR UNIT", "NOTES", "LINKED", "CUMULATIVE", 
+    "EXCHANGE CERTIFICATE", "APPRECIATION FUND", "INCOME TRUST", 
+    "REAL ESTATE INVESTMENT TRUST", "MORTGAGE INCOME FUND", "REAL ESTATE FUND", 
+    "HIGH INCOME MORTGAGE FUND", "NOTES", "PRIN PROTECTED", 
+    "PRESERVATION LISTED FUCOMMERCIAL REIT", "REDEEMABLE UNITS", 
+    "REAL ESTATE UNITS", "INFRASTRUCTURE FUND TRUST UNIT", "STRATEGY FUND", 
+    "INCOME REIT", "FINANCIAL TRUST", "SERIES", "REAL ESTATE INVESTMENT", 
+    "ALLOCATION TRUST", "BACKED", "ADVANTAGED", "RECOVERY FUND", "LOAN FUND", 
+    "SENIOR LOAD FUND", "PROPERTY SERIES", "OFFERED SHARES", "CDA", "CNQ", 
+    "PROPERTY TRUST", "EQUITIES", "FAMILY CORE FUND", "FAMILY CORE CLASS", 
+    "SUBSCRIPTION RECEIPTS", "MBS TRUST", "UNIT PARTNERSHIP", "REIT LP", 
+    "PARTICIPATING SECURITIES", "CANADIAN FUND", "EQUITY FUND", 
+    "CONVERTIBLE FUND", "DEBANTURE", "CONVERTIBLE", "FOCUS FUND", 
+    "SPLIT PRIORITY SHARES", "SPLIT", "NIL PAID", "TOTAL RETURN TRUST", 
+    "BALANCED FUND", "CREDIT FUND", "VOTING RIGHTS", "VOTING SHARES", "UNT"],
+    
+    'AUSTRIA':
+    ['CERTIFICATE', ' ZT ', ' NK5 ', 'DUPLICATE', 'PARTICIPATION CERTIFICATE', 
+     'CERT ', ' VI ', 'REIT ',' % S ', 'NIL PAID'], 
+    
+    'AZERBAIJAN':
+    [], 
+    
+    'BELGIUM':
+    ['STR ', 'STR VV ', ' STRIP', ' STRIPS', ' VVPR', 'CERTIFICATE', ' CERT', ' PC ', 
+     ' CNP ', ' IDR', ' UNITS', 'DELAWARE', ' ST VV', ' CS 1', ' STRIP VV PR', 
+     'FULLY', ' CVA', ' RNC', 'RIGHTS', ' REIT'], 
+    
+    'BOSNIA AND HERZEGOVINA':
+    [], 
+    
+    'BULGARIA':
+    ['FUND', 'REIT', 'NIL PAID', 'MONTSTROY'], 
+    
+    'CROATIA':
+    ['PREFERENCE SHARES', ' PIF'], 
+    
+    'CZECH REPUBLIC':
+    [], 
+    
+    'CYPRUS':
+    ['NIL PAID', ' RTS'], 
+    
+    'DENMARK':
+    ['NIL PAID', 'REGD CERT'], 
+    
+    'ESTONIA':
+    ['ADDITIONAL SHARE', ' NRFD', 'TUIENDAV AKTSIA'], 
+    
+    'FINLAND':
+    [' FDR', 'SUBSCRIPTION RECEIPT', 'SALES RIGHTS'], 
+    
+    'FRANCE':
+    ['CERTIFICATE', 'DELAWARE', 'LIMITED DATA', 'BONUS RIGHTS', ' BDR', ' ADP', 
+     ' SPA', 'PREFERRED', 'STOCK DIVIDEND', 'SPA RP', ' AFV ', 'NIL PAID', ' NV ', 
+     ' NRFD ', 'NR ', ' CVA', 'DROIT DE VOTE', ' PS ', 'NIL PAID', ' ADP', 
+     ' FDR'],
+    
+    'GERMANY':
+    ['REIT', ' SWAP', 'GENUSSSCHEINE', 'PREFERENCE', ' NPV', 'NIL PAID', 
+     'BONUS RIGHTS', ' GS ', ' PF ', 'SUB RIGHTS', ' CDI ', ' RSP ', 
+     'DEPOSITORY RECEIPTS', ' UNIT ', 'CHESS DEPOSITORY INTEREST', 'DEFERRED', 
+     'PARTICIPATE CERTIFICATE', 'LIMITED PARTENERSHIP', ' GDRS', ' TRUST', ' REIT', 
+     ' REFINERY'], 
+    
+    'GREECE':
+    [' PR ', ' UNITS', 'PREFERENCE'], 
+    
+    'HUNGARY':
+    [' UNITS', ' TRUST'], 
+    
+    'ICELAND':
+    [], 
+    
+    'IRELAND':
+    ['DUPLICATE', ' FUND', ' UNITS', ' REIT'], 
+    
+    'ITALY':
+    [' RSP', ' CONV RTS', 'NIL PAID', 'SUB RIGHTS', 'BONUS RIGHTS', ' RIGHTS ', 
+     ' RP ', ' RCV', ' NRFD', 'FULLY PAID', 'FULLY PIAD', ' ETN '], 
+    
+    'KAZAKHSTAN':
+    ['PREFERENCE LIMITED', 'PREFERENCE SHARES'], 
+    
+    'LATVIA':
+    ['FB '], 
+    
+    'LITHUANIA':
+    [], 
+    
+    'LUXEMBOURG':
+    [' IDR ', 'DEPOSITARY RECEIPT', 'DEPOSITARY', ' EDR ', ' VVPR', 'DELAWARE', 
+     ' EDR ', ' CDR ', ' FDR ', ' CERT', ' GDR ', ' BDR'], 
+    
+    'NORTH MACEDONIA':
+    [], 
+    
+    'MALTA':
+    [], 
+    
+    'MONTENEGRO':
+    [], 
+    
+    'NETHERLANDS':
+    ['CERTIFICATE', 'DUPLICATE', 'DEPOSITARY', 'BONUS RIGHTS', ' % STOCK ', ' CERT', 
+     'CERTS', 'TRUST INCOME', ' STRIP', ' CT ', ' DUPL', ' UNITS', ' SPA ', 
+     'STRIP VVPR', 'PREFERENCE'], 
+    
+    'NORWAY':
+    [' DUPLI', 'NEW SHARES', 'NIL PAID'], 
+    
+    'POLAND':
+    ['NIL PAID'], 
+    
+    'PORTUGAL':
+    ['BONUS RIGHT', 'NIL PAID'], 
+    
+    'ROMANIA':
+    [], 
+    
+    'RUSSIAN FEDERATION':
+    [' PREF', 'TRAST', ' RDP', 'PREFERENCE', ' PREF.'], 
+    
+    'SERBIA':
+    [' CF '], 
+    
+    'SLOVAKIA':
+    [' FOND', ' VP', ' POV P', ' PP', ' LINKV', ' ZSP'], 
+    
+    'SLOVENIA':
+    [], 
+    
+    'SPAIN':
+    ['NIL PAID', 'BONUS RIGHTS', 'BUNUS RIGHTS', ' SHARES', ' LIMITED DATA', 
+     ' CPO '], 
+    
+    'SWEDEN':
+    [' SDB', ' UNIT', 'NIL PAID REDEMPTION', ' REDEMP', ' SDR', 'FULLY PAID', 
+     ' RFD', 'INTERIM SHARE', ' RIGHTS', 'DEPOSITARY', 'RECEIPTS', ' SR 1', 
+     ' RFD'], 
+    
+    'SWITZERLAND':
+    ['WHEN ISSUED', 'CERTIFICATE', 'DELAWARE', ' SERIES', 'REAL ESTATE FUND', 
+     ' CERT', 'DUPLICATE', ' UNITS', ' BOND', 'BONUS RIGHTS', 'REAL ESTATE IFCA', 
+     'PROPERTY FUND', ' MIXED', ' REIT', 'COMMERCIAL FUND', ' DRC'], 
+    
+    'TURKEY':
+    ['CERT', ' NRFD', 'NIL PAID', 'FULLY PAID'], 
+    
+    'UNITED KINGDOM':
+    [' FUND ', ' TRUST ', 'NIL PAID', 'STOCK UNIT', 'ANNUITY UNIT', 'UNIT £', 
+     'UNIT TRUST', ' UNITS', ' ZDP ', 'REIT', 'POST RED', 'DEPOSITARY', ' RECEIPT', 
+     'INTERIM SHARES', 'REEDEMABLE', 'PREFERENCE', 'INVESTMENT TRUST', ' ADR',
+     'FULLY PAID', 'PARTLY PAID', ' BDR', ' NRDF', 'DEFERRED'], 
+    
+    'UKRAINE':
+    [' CF ', ' FUND', ' CLOSED FUND '] 
+    
+}
+
+# one alternation of the escaped patterns per country, built once at import instead of on every call of filter (1)
+equity_identifer_patterns = {country: "|".join(re.escape(p) for p in patterns) for country, patterns in equity_identifers.items()}
+# the name patterns are literals, up to this many of them are searched one by one, longer lists are scanned as one alternation
+max_literal_scans = 20
+
+# exchange suffixes of cross-listed stocks per country (regular expressions), see filter (2)
+cross_listings_dict = {
+    'UNITED STATES':
+    r"\(NYS\)|\(NAS\)|\(ASE\)|\(OTC\)|\(XSQ\)|\(XQB\)",
+
+    'CANADA':
+    r"\(TSX\)|\(VSE\)|\(MON\)|\(TSE\)|\(TOR\)",
+    
+    'AUSTRIA':
+    r"\(WBO\)", 
+    
+    'AZERBAIJAN':
+    r"", 
+    
+    'BELGIUM':
+   r"\(BRU\)", 
+    
+    'BOSNIA AND HERZEGOVINA':
+    r"", 
+    
+    'BULGARIA':
+    r"", 
+    
+    'CROATIA':
+    r"", 
+    
+    'CZECH REPUBLIC':
+    r"\(PRA\)", 
+    
+    'CYPRUS':
+    r"\(CYP\)", 
+    
+    'DENMARK':
+    r"\(CSE\)", 
+    
+    'ESTONIA':
+    r"", 
+    
+    'FINLAND':
+    r"\(HEL\)", 
+    
+    'FRANCE':
+    r"\(PAR\)",
+    
+    'GERMANY':
+    r"\(FRA\)|\(STU\)|\(HAM\)|\(DUS\)|\(MUN\)|\(XET\)", 
+    
+    'GREECE':
+    r"\(ATH\)", 
     
+    'HUNGARY':
+    r"\(BUD\)", 
+    
+    'ICELAND':
+    r"\(ICE\)", 
+    
+    'IRELAND':
+    r"\(DUB\)|\(IEX\)|\(ESM\)", 
+    
+    'ITALY':
+    r"\(MIL\)", 
+    
+    'KAZAKHSTAN':
+    r"\(KAZ\)", 
+    
+    'LATVIA':
+    r"", 
+    
+    'LITHUANIA':
+    r"", 
+    
+    'LUXEMBOURG':
+    r"\(LUX\)", 
+    
+    'NORTH MACEDONIA':
+    r"", 
+    
+    'MALTA':
+    r"\(MALTA\)|\(MAL.\)", 
+    
+    'MONTENEGRO':
+    r"", 
+    
+    'NETHERLANDS':
+    r"\(AMS\)|\(FL\)", 
+    
+    'NORWAY':
+    r"\(OSL\)", 
+    
+    'POLAND':
+    r"\(WAR\)", 
+    
+    'PORTUGAL':
+    r"\(LIS\)", 
+    
+    'ROMANIA':
+    r"\(BSE\)", 
+    
+    'RUSSIAN FEDERATION':
+    r"", 
+    
+    'SERBIA':
+    r"", 
+    
+    'SLOVAKIA':
+    r"", 
+    
+    'SLOVENIA':
+    r"", 
+    
+    'SPAIN':
+    r"\(MAD\)", 
+    
+    'SWEDEN':
+    r"\(OME\)|\(XSQ\)", 
+    
+    'SWITZERLAND':
+    r"\(SWX\)|\(BRN\)", 
+    
+    'TURKEY':
+    r"\(IST\)", 
+    
+    'UNITED KINGDOM':
+    r"\(LON\)|\(UNITED KINGDOM\)", 
+    
+    'UKRAINE':
+    r"" 
+    
+}
+
+# country names of the country codes, see filter (4)
+country_codes_dict = {
+
+    'USA':
+    "UNITED STATES",
+
+    'Canada':
+    "CANADA",
+
+    'Austria':
+    "AUSTRIA",
+
+    'Azerbaijan':
+    "AZERBAIJAN",
+
+    'Belgium':
+    "BELGIUM",
+
+    'Bosnia-Herzegovina':
+    "BOSNIA AND HERZEGOVINA",
+
+    'Bulgaria':
+    "BULGARIA",
+
+    'Croatia':
+    "CROATIA",
+
+    'Czech Republic':
+    "CZECH REPUBLIC",
+
+    'Cyprus':
+    "CYPRUS",
+
+    'Denmark':
+    "DENMARK",
+
+    'Estonia':
+    "ESTONIA",
+
+    'Finland':
+    "FINLAND",
+
+    'France':
+    "FRANCE",
+
+    'Germany':
+    "GERMANY",
+
+    'Greece':
+    "GREECE",
+
+    'Hungary':
+    "HUNGARY",
+
+    'Iceland':
+    "ICELAND",
+
+    'Ireland':
+    "IRELAND",
+
+    'Italy':
+    "ITALY",
+
+    'Kazakhstan':
+    "KAZAKHSTAN",
+
+    'Latvia':
+    "LATVIA",
+
+    'Lithuania':
+    "LITHUANIA",
+
+    'Luxembourg':
+    "LUXEMBOURG",
+
+    'Macedonia':
+    "MACEDONIA",
+
+    'Malta':
+    "MALTA",
+
+    'Montenegro':
+    "MONTENEGRO",
+
+    'Netherlands':
+    "NETHERLANDS",
+
+    'Norway':
+    "NORWAY",
+
+    'Poland':
+    "POLAND",
+
+    'Portugal':
+    "PORTUGAL",
+
+    'Romania':
+    "ROMANIA",
+
+    'Russia':
+    "RUSSIAN FEDERATION",
+
+    'Serbia':
+    "SERBIA",
+
+    'Slovakia':
+    "SLOVAKIA",
+
+    'Slovenia':
+    "SLOVENIA",
+
+    'Spain':
+    "SPAIN",
+
+    'Sweden':
+    "SWEDEN",
+
+    'Switzerland':
+    "SWITZERLAND",
+
+    'Turkey':
+    "TURKEY",
+
+    'UK':
+    "UNITED KINGDOM",
+
+    'Ukraine':
+    "UKRAINE"
+
+}
+
+# country -> earliest allowable date (DD-MM-YYYY), see filter (17)
+country_start_dates = {
+    'UNITED STATES': '31-12-1984',
+    'CANADA': '31-12-1983',
+    'AUSTRIA': '31-12-1991',
+    'AZERBAIJAN': '31-12-1900',
+    'BELGIUM': '31-12-1991',
+    'BOSNIA AND HERZEGOVINA': '31-12-2009',
+    'BULGARIA': '31-12-2005',
+    'CROATIA': '31-12-2005',
+    'CZECH REPUBLIC': '31-12-1995',
+    'CYPRUS': '31-12-2009',
+    'DENMARK': '31-12-1987',
+    'ESTONIA': '31-12-2009',
+    'FINLAND': '31-12-1987',
+    'FRANCE': '31-12-1981',
+    'GERMANY': '31-12-1988',
+    'GREECE': '31-12-1995',
+    'HUNGARY': '31-12-1999',
+    'ICELAND': '31-12-2005',
+    'IRELAND': '31-12-1989',
+    'ITALY': '31-12-1988',
+    'KAZAKHSTAN': '31-12-2013',
+    'LATVIA': '31-12-2009',
+    'LITHUANIA': '31-12-2007',
+    'LUXEMBOURG': '31-12-1994',
+    'NORTH MACEDONIA': '31-12-2009',
+    'MALTA': '31-03-2004',
+    'MONTENEGRO': '31-12-2012',
+    'NETHERLANDS': '31-12-1986',
+    'NORWAY': '31-12-1986',
+    'POLAND': '31-12-1995',
+    'PORTUGAL': '31-12-1991',
+    'ROMANIA': '31-12-2008',
+    'RUSSIAN FEDERATION': '31-12-2004',
+    'SERBIA': '31-12-2009',
+    'SLOVAKIA': '31-12-2007',
+    'SLOVENIA': '31-12-2005',
+    'SPAIN': '31-12-1992',
+    'SWEDEN': '31-12-1986',
+    'SWITZERLAND': '31-12-1982',
+    'TURKEY': '31-12-1994',
+    'UNITED KINGDOM': '31-12-1984',
+    'UKRAINE': '31-12-2006',
+}
+# parsed once at import, filter (17) compares them with the datetime64[ns] dates of the panel
+country_start_datetimes = {country: np.datetime64(pd.to_datetime(date, format='%d-%m-%Y'), 'ns') for country, date in country_start_dates.items()}
+
+# currencies of the domestic stocks per country, see filter (5)
+currencies_dict = {
+
+    'UNITED STATES':
+    ['U$'],
+
+    'CANADA':
+    ['C$'],
+
+    'AUSTRIA':
+    ['AS', 'E'],
+
+    'AZERBAIJAN':
+    ['AM'],
+
+    'BELGIUM':
+    ['BF', 'E'],
+
+    'BOSNIA AND HERZEGOVINA':
+    ['BO'],
+
+    'BULGARIA':
+    ['BL'],
+
+    'CROATIA':
+    ['KA', 'E'],
+
+    'CZECH REPUBLIC':
+    ['CK', 'E'],
+
+    'CYPRUS':
+    ['CY', 'E'],
+
+    'DENMARK':
+    ['DK'],
+
+    'ESTONIA':
+    ['EK', 'E'],
+
+    'FINLAND':
+    ['M', 'E'],
+
+    'FRANCE':
+    ['FF', 'E'],
+
+    'GERMANY':
+    ['DM', 'E'],
+
+    'GREECE':
+    ['DR', 'E'],
+
+    'HUNGARY':
+    ['HF'],
+
+    'ICELAND':
+    ['IK'],
+
+    'IRELAND':
+    ['£E', 'E'],
+
+    'ITALY':
+    ['L', 'E'],
+
+    'KAZAKHSTAN':
+    ['KT'],
+
+    'LATVIA':
+    ['LV', 'E'],
+
+    'LITHUANIA':
+    ['LT', 'E'],
+
+    'LUXEMBOURG':
+    ['LF', 'E'],
+
+    'NORTH MACEDONIA':
+    ['MC'],
+
+    'MALTA':
+    ['M£', 'E'],
+
+    'MONTENEGRO':
+    ['E'],
+
+    'NETHERLANDS':
+    ['FL', 'E'],
+
+    'NORWAY':
+    ['NK'],
+
+    'POLAND':
+    ['PZ'],
+
+    'PORTUGAL':
+    ['PE', 'E'],
+
+    'ROMANIA':
+    ['RL'],
+
+    'RUSSIAN FEDERATION':
+    ['UR', 'U$'],
+
+    'SERBIA':
+    ['YD'],
+
+    'SLOVAKIA':
+    ['KK', 'E'],
+
+    'SLOVENIA':
+    ['TO', 'E'],
+
+    'SPAIN':
+    ['EP', 'E'],
+
+    'SWEDEN':
+    ['SK'],
+
+    'SWITZERLAND':
+    ['SF'],
+
+    'TURKEY':
+    ['TL'],
+
+    'UNITED KINGDOM':
+    ['£'],
+
+    'UKRAINE':
+    ['KB']
+
+}
+
+class DSPreprocess:
+
+    @staticmethod
+    def prepare(panel, statics, category_columns=['GEOGN', 'TRAC', 'ISINID', 'PCUR']):
+        """
+        Converts the stock codes and the low-cardinality static columns to categoricals before filtering,
+        so that the comparisons, isin selections, groupbys and merges on them work on integer codes.
+        The panel dates are parsed once here, the filters compare them as datetime64[ns] without converting them again.
+
+        Parameters:
+            panel (pd.DataFrame): Time series panel data with 'Stock' and 'Date' columns.
+            statics (pd.DataFrame): Static metadata with a 'DSCD' column and the columns in category_columns.
+            category_columns (list): Static columns with few distinct values, e.g. countries and currencies.
+
+        Returns:
+            Tuple[pd.DataFrame, pd.DataFrame]: The panel and statics, 'Stock' and 'DSCD' share one categorical dtype with sorted categories.
+        """
+        # for categorical stock codes only the distinct codes of the panel are collected, not one string per row
+        panel_stocks = np.asarray(panel['Stock'].unique(), dtype=object)
+        stock_dtype  = pd.CategoricalDtype(np.sort(pd.unique(np.concatenate([panel_stocks, statics['DSCD'].to_numpy(dtype=object)]))))
+        # a no-op for dates that already come as datetime64[ns]
+        panel        = panel.astype({'Stock': stock_dtype, 'Date': 'datetime64[ns]'})
+        statics      = statics.astype({'DSCD': stock_dtype} | {column: 'category' for column in category_columns if column in statics.columns})
+        return panel, statics
+
+    @staticmethod
+    def panel_stocks(panel, rows=None):
+        """
+        Returns the distinct stocks of the panel, or of its selected rows, as frame with a 'Stock' column.
+        Filters (1) to (5) keep or remove whole stocks based on the statics only. They are applied to this frame and the panel
+        rows are selected once afterwards, instead of copying the full panel after every filter.
+
+        Parameters:
+            panel (pd.DataFrame): Time series panel data with a 'Stock' column.
+            rows (np.ndarray): Optional boolean mask of the panel rows whose stocks are collected (default all rows).
+
+        Returns:
+            pd.DataFrame: One row per stock.
+        """
+        stocks = panel['Stock'] if rows is None else panel.loc[rows, 'Stock']
+        return pd.DataFrame({'Stock': stocks.unique()})
+
+    @staticmethod
+    def final_panel(panel):
+        """
+        Returns the filtered panel for saving: rows without a finite return are dropped and the stock codes become plain strings.
+        Filter (0) already replaced infinite values in all columns, only Return is checked once more before dropping missing returns.
+
+        Parameters:
+            panel (pd.DataFrame): Time series panel data with 'Stock' and 'Return' columns.
+
+        Returns:
+            pd.DataFrame: The panel rows with a finite return.
+        """
+        panel_final = panel[np.isfinite(panel["Return"].to_numpy())]
+        # plain stock codes in the output
+        stock_dtype = panel["Stock"].dtype
+        return panel_final.astype({column: str for column, dtype in panel_final.dtypes.items() if dtype == stock_dtype})
+
+    @staticmethod
+    def apply_per_country(filter_func, panel, statics, max_workers=1, **kwargs):
+        """
+        Applies a country specific filter to the stocks of every country in statics and stacks the filtered panels.
+        The panel is split into countries once instead of selecting the stocks of each country with a separate scan.
+        The countries are disjoint, with max_workers > 1 they are filtered in a thread pool that shares panel and statics
+        without copying them (the per-country log lines then appear in order of completion).
+
+        Parameters:
+            filter_func (callable): Filter with signature filter_func(panel, statics, country, **kwargs), e.g. DSPreprocess.filter_cross_listings.
+            panel (pd.DataFrame): Time series panel data with a 'Stock' column.
+            statics (pd.DataFrame): Static metadata with 'DSCD' (stock code) and 'GEOGN' (country).
+            max_workers (int): Number of countries filtered concurrently (default 1, one after the other).
+            **kwargs: Passed on to filter_func.
+
+        Returns:
+            pd.DataFrame: Filtered panels of all countries (in order of appearance in statics) with a new index.
+        """
+        # plain list in order of appearance, the unique values of a categorical column would bring along all its categories
+        countries     = statics["GEOGN"].unique().tolist()
+        stock_country = statics.drop_duplicates(subset="DSCD").set_index("DSCD")["GEOGN"]
+        country_codes = pd.Categorical(panel["Stock"].map(stock_country), categories=countries).codes
+
+        # bring the rows of each country together once (stable, so the row order within a country is kept),
+        # every country is then a contiguous slice; stocks without country (code -1) end up in front of the first slice
+        order        = np.argsort(country_codes, kind="stable")
+        panel_sorted = panel.take(order)
+        bounds       = np.searchsorted(country_codes[order], np.arange(len(countries) + 1))
+
+        def filter_country(code):
+            return filter_func(panel_sorted.iloc[bounds[code]:bounds[code + 1]], statics, country=countries[code], **kwargs)
+
+        if max_workers > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                panels_filtered = list(executor.map(filter_country, range(len(countries))))
+        else:
+            panels_filtered = [filter_country(code) for code in range(len(countries))]
+        return pd.concat(panels_filtered, ignore_index=True)
+
+
     @staticmethod
     def handle_missings(panel, statics, country,
             ffill_cols=['Open', 'High', 'Low', 'Close', 'Volume', 'ReturnIndex', 'AdjFactor', 'UnadjClose'],
@@ -66,33 +1142,35 @@ class DSPreprocess:
           with missing MarketCAP filled by that country's median MarketCAP (per date).
         """
         country_stocks = statics.loc[statics["GEOGN"] == country, "DSCD"].unique()
-        panel = panel[panel["Stock"].isin(country_stocks)].copy()
-        panel.replace([np.inf, -np.inf], np.nan, inplace=True)
-
-        def drop_and_fill_missings(group):
-            valid_rows = group.dropna(subset=ffill_cols, how='any')
+        panel = panel[in_stocks(panel["Stock"], country_stocks)].replace([np.inf, -np.inf], np.nan)
 
-            if not valid_rows.empty:
-                first_valid_date = valid_rows['Date'].min()
-
-                group = group[group['Date'] >= first_valid_date]
-                group[ffill_cols] = group[ffill_cols].ffill()  # forward fill any cols used in modeling:
-                if bfill_cols is not None:
-                    group[bfill_cols] = group[bfill_cols].ffill().bfill()  # backward fill cols used only for analysis:
-                return group
-            else:
-                return group.iloc[0:0]
+        # per stock in date order, the panel usually already comes in this order
+        panel_sorted = sort_by_stock_date(panel)
 
-        panel_filtered = panel.groupby('Stock', group_keys=False)[panel.columns].apply(drop_and_fill_missings)
+        # drop the rows before the first date per stock on which all modeling columns are observed, stocks without such a date are dropped
+        keep           = first_complete_mask(panel_sorted['Date'].to_numpy(dtype="datetime64[ns]").view(np.int64),
+                                             np.asfortranarray(panel_sorted[ffill_cols].to_numpy(dtype=np.float64)),
+                                             stock_bounds(panel_sorted))
+        panel_filtered = panel_sorted[keep]
+        bounds         = stock_bounds(panel_filtered)
 
+        fill_columns = [(ffill_cols, False)]  # forward fill any cols used in modeling:
         if bfill_cols is not None:
-            panel_filtered[bfill_cols] = panel_filtered[bfill_cols].fillna(
-                panel_filtered.groupby('Date')[bfill_cols].transform('median')
-            )
-        else:
-            panel_filtered['MarketCAP'] = panel_filtered['MarketCAP'].fillna(
-                panel_filtered.groupby('Date')['MarketCAP'].transform('median')
-            )
+            fill_columns.append((bfill_cols, True))  # forward and then backward fill cols used only for analysis:
+        for columns, backward in fill_columns:
+            # writable copy, one contiguous array per column
+            values = np.array(panel_filtered[columns].to_numpy(dtype=np.float64), order='F')
+            fill_missings(values, bounds, backward)
+            for j, column in enumerate(columns):
+                panel_filtered[column] = values[:, j].astype(panel_filtered[column].dtype)
+
+        # after the grouped fills only stocks without any value of a column are still missing, they get the daily median.
+        # The medians are aggregated once per date and looked up for the dates of the panel rows, and only if anything is missing.
+        median_cols = bfill_cols if bfill_cols is not None else ['MarketCAP']
+        if panel_filtered[median_cols].isna().to_numpy().any():
+            daily_medians = panel_filtered.groupby('Date', sort=False)[median_cols].median()
+            row_medians   = daily_medians.reindex(panel_filtered['Date']).set_axis(panel_filtered.index)
+            panel_filtered[median_cols] = panel_filtered[median_cols].fillna(row_medians)
 
         if panel.shape[0] == 0:
             removal_percentage = 0
@@ -118,224 +1196,35 @@ class DSPreprocess:
         Returns:
           pd.DataFrame: A filtered version of the panel dataset with only stocks that pass the filter.
         """
-   
-        equity_identifers = {
-            'UNITED STATES':
-            [" TRUST ", " REPR ", " RIGHT", " SERIES ", " NV ", " IV TST",
-            "REAL ESTATE INVESTMENT", "REALTY ", " RLTY", "ROYALTY INVESTMENT",
-            "ASSET INVESTMENT", "CAPITAL INVESTMENT", "ASSET MANAGEMENT",
-            "CAPITAL MANAGEMENT", "INVESTMENT MANAGEMENT", "VENTURE CAPITAL",
-            "FINANCIAL SHBI", "PROPERTY INVESTORS", "INCOME PROPERTY", " UNITS ",
-            " UNIT ", "LIMITED PARTENERSHIP", "FUND ", "EQUITY PARTNERS",
-            "LIMITED VOTING", "SUB VOTING", "TIER ONE SUB", "VARIABLE VOTING",
-            "NON VOTINGREIT ", " RESIDENTIAL", "R E I T", "BENEFICIAL",
-            "BENEFICIARY", "BENEFIT INTEREST", "BEN INTEREST", "SH BEN INT ",
-            "WARRANT", "WRTS", " L P ", "L P INTEREST", "LP UT", "HOLDINGS LP",
-            "PARTENERS UNIT", "PART INT", "UNIT PARTENERSHIP", "UNIT LIMITED",
-            " MORTGAGE", " REAL ESTATE", "CERTIFICATE", "NO PAR VALUE",
-            "HOLDING UNIT", " BACKED", " ST MIN", " CORTS ", " TORPS ", " TOPRS ",
-            "SECURITIES TRUPS", " QUIPS ", "STRATS HIGH YIELD", "TOTAL RETURN",
-            "DIVERSIFIED HOLDINGS", "(SICAV)", "DEPOSITARY", "DEPOSITOR",
-            " RECEIPT", "REP & SHARES", " GLOBAL SHARES", " ADR ", " GDR", "EXPD.",
-            "EXPIRED", "DUPLICATE", "CONVERTIBLE", "CNVRT.", "CONVRT.", "EXCH.",
-            "DEBANTURE", "(DEB)", "NIL PAID", "STRUCTURED ASSET", " CALLABLE",
-            "FLOATING RATE", " ADJUSTABLE", "REDEEMABLE", " PAIRED CTF",
-            "CONSOLIDATED", "INSURED", "CAPITAL SHARES", "DEBT STRATEGIES",
-            "LIQUIDATING", "LIQUID UNIT", "L UNIT", "- LASD", "ACQUISITION",
-            "CAP UNIT", "INCOME UNIT", "PREFERRED"],
-
-            'CANADA': 
-            ["SUBSCRIPTION RIGHTS", "FUND SHARES", "INVESTMENT TRUST", "UNIT", "EXPD", 
-            "PROPERTY TRUST", "N L", "NL", "INCOME TRUST UNITS", "INCOME COMMERCE", 
-            "EXPIRY", "NL ORDINARY", "COMMERCE PAR", "DEFERRED", "EXPIRED", "CDN", 
-            "INCOME FUND", "SUBSCRIPTION RECEIPTS", "RECEIPT", "RIGHTS", "SUB VOTING", 
-            "TRUST UNIT", "MBS TRUST", "BOND FUND", "PARTNERSHIP UNIT", "PARTNER UNIT", 
-            "REIT", "FUND UNITS", "LOAN FUND", "RIGHTS", "CONVERTIBLE FUND", 
-            "PREFERENCE SHARES", "COMBINED UNITS", '"IDS" UNITS', "SPLIT", "REDEEMABLE", 
-            "DIVIDEND FUND", "TOTAL RETURN", "DEBENTURE", "WARRANT", "CREDIT FUND", 
-            "ETF", "STAPLE", "INDEX NOTES", "TR UNIT", "NOTES", "LINKED", "CUMULATIVE", 
-            "EXCHANGE CERTIFICATE", "APPRECIATION FUND", "INCOME TRUST", 
-            "REAL ESTATE INVESTMENT TRUST", "MORTGAGE INCOME FUND", "REAL ESTATE FUND", 
-            "HIGH INCOME MORTGAGE FUND", "NOTES", "PRIN PROTECTED", 
-            "PRESERVATION LISTED FUCOMMERCIAL REIT", "REDEEMABLE UNITS", 
-            "REAL ESTATE UNITS", "INFRASTRUCTURE FUND TRUST UNIT", "STRATEGY FUND", 
-            "INCOME REIT", "FINANCIAL TRUST", "SERIES", "REAL ESTATE INVESTMENT", 
-            "ALLOCATION TRUST", "BACKED", "ADVANTAGED", "RECOVERY FUND", "LOAN FUND", 
-            "SENIOR LOAD FUND", "PROPERTY SERIES", "OFFERED SHARES", "CDA", "CNQ", 
-            "PROPERTY TRUST", "EQUITIES", "FAMILY CORE FUND", "FAMILY CORE CLASS", 
-            "SUBSCRIPTION RECEIPTS", "MBS TRUST", "UNIT PARTNERSHIP", "REIT LP", 
-            "PARTICIPATING SECURITIES", "CANADIAN FUND", "EQUITY FUND", 
-            "CONVERTIBLE FUND", "DEBANTURE", "CONVERTIBLE", "FOCUS FUND", 
-            "SPLIT PRIORITY SHARES", "SPLIT", "NIL PAID", "TOTAL RETURN TRUST", 
-            "BALANCED FUND", "CREDIT FUND", "VOTING RIGHTS", "VOTING SHARES", "UNT"],
-            
-            'AUSTRIA':
-            ['CERTIFICATE', ' ZT ', ' NK5 ', 'DUPLICATE', 'PARTICIPATION CERTIFICATE', 
-             'CERT ', ' VI ', 'REIT ',' % S ', 'NIL PAID'], 
-            
-            'AZERBAIJAN':
-            [], 
-            
-            'BELGIUM':
-            ['STR ', 'STR VV ', ' STRIP', ' STRIPS', ' VVPR', 'CERTIFICATE', ' CERT', ' PC ', 
-             ' CNP ', ' IDR', ' UNITS', 'DELAWARE', ' ST VV', ' CS 1', ' STRIP VV PR', 
-             'FULLY', ' CVA', ' RNC', 'RIGHTS', ' REIT'], 
-            
-            'BOSNIA AND HERZEGOVINA':
-            [], 
-            
-            'BULGARIA':
-            ['FUND', 'REIT', 'NIL PAID', 'MONTSTROY'], 
-            
-            'CROATIA':
-            ['PREFERENCE SHARES', ' PIF'], 
-            
-            'CZECH REPUBLIC':
-            [], 
-            
-            'CYPRUS':
-            ['NIL PAID', ' RTS'], 
-            
-            'DENMARK':
-            ['NIL PAID', 'REGD CERT'], 
-            
-            'ESTONIA':
-            ['ADDITIONAL SHARE', ' NRFD', 'TUIENDAV AKTSIA'], 
-            
-            'FINLAND':
-            [' FDR', 'SUBSCRIPTION RECEIPT', 'SALES RIGHTS'], 
-            
-            'FRANCE':
-            ['CERTIFICATE', 'DELAWARE', 'LIMITED DATA', 'BONUS RIGHTS', ' BDR', ' ADP', 
-             ' SPA', 'PREFERRED', 'STOCK DIVIDEND', 'SPA RP', ' AFV ', 'NIL PAID', ' NV ', 
-             ' NRFD ', 'NR ', ' CVA', 'DROIT DE VOTE', ' PS ', 'NIL PAID', ' ADP', 
-             ' FDR'],
-            
-            'GERMANY':
-            ['REIT', ' SWAP', 'GENUSSSCHEINE', 'PREFERENCE', ' NPV', 'NIL PAID', 
-             'BONUS RIGHTS', ' GS ', ' PF ', 'SUB RIGHTS', ' CDI ', ' RSP ', 
-             'DEPOSITORY RECEIPTS', ' UNIT ', 'CHESS DEPOSITORY INTEREST', 'DEFERRED', 
-             'PARTICIPATE CERTIFICATE', 'LIMITED PARTENERSHIP', ' GDRS', ' TRUST', ' REIT', 
-             ' REFINERY'], 
-            
-            'GREECE':
-            [' PR ', ' UNITS', 'PREFERENCE'], 
-            
-            'HUNGARY':
-            [' UNITS', ' TRUST'], 
-            
-            'ICELAND':
-            [], 
-            
-            'IRELAND':
-            ['DUPLICATE', ' FUND', ' UNITS', ' REIT'], 
-            
-            'ITALY':
-            [' RSP', ' CONV RTS', 'NIL PAID', 'SUB RIGHTS', 'BONUS RIGHTS', ' RIGHTS ', 
-             ' RP ', ' RCV', ' NRFD', 'FULLY PAID', 'FULLY PIAD', ' ETN '], 
-            
-            'KAZAKHSTAN':
-            ['PREFERENCE LIMITED', 'PREFERENCE SHARES'], 
-            
-            'LATVIA':
-            ['FB '], 
-            
-            'LITHUANIA':
-            [], 
-            
-            'LUXEMBOURG':
-            [' IDR ', 'DEPOSITARY RECEIPT', 'DEPOSITARY', ' EDR ', ' VVPR', 'DELAWARE', 
-             ' EDR ', ' CDR ', ' FDR ', ' CERT', ' GDR ', ' BDR'], 
-            
-            'NORTH MACEDONIA':
-            [], 
-            
-            'MALTA':
-            [], 
-            
-            'MONTENEGRO':
-            [], 
-            
-            'NETHERLANDS':
-            ['CERTIFICATE', 'DUPLICATE', 'DEPOSITARY', 'BONUS RIGHTS', ' % STOCK ', ' CERT', 
-             'CERTS', 'TRUST INCOME', ' STRIP', ' CT ', ' DUPL', ' UNITS', ' SPA ', 
-             'STRIP VVPR', 'PREFERENCE'], 
-            
-            'NORWAY':
-            [' DUPLI', 'NEW SHARES', 'NIL PAID'], 
-            
-            'POLAND':
-            ['NIL PAID'], 
-            
-            'PORTUGAL':
-            ['BONUS RIGHT', 'NIL PAID'], 
-            
-            'ROMANIA':
-            [], 
-            
-            'RUSSIAN FEDERATION':
-            [' PREF', 'TRAST', ' RDP', 'PREFERENCE', ' PREF.'], 
-            
-            'SERBIA':
-            [' CF '], 
-            
-            'SLOVAKIA':
-            [' FOND', ' VP', ' POV P', ' PP', ' LINKV', ' ZSP'], 
-            
-            'SLOVENIA':
-            [], 
-            
-            'SPAIN':
-            ['NIL PAID', 'BONUS RIGHTS', 'BUNUS RIGHTS', ' SHARES', ' LIMITED DATA', 
-             ' CPO '], 
-            
-            'SWEDEN':
-            [' SDB', ' UNIT', 'NIL PAID REDEMPTION', ' REDEMP', ' SDR', 'FULLY PAID', 
-             ' RFD', 'INTERIM SHARE', ' RIGHTS', 'DEPOSITARY', 'RECEIPTS', ' SR 1', 
-             ' RFD'], 
-            
-            'SWITZERLAND':
-            ['WHEN ISSUED', 'CERTIFICATE', 'DELAWARE', ' SERIES', 'REAL ESTATE FUND', 
-             ' CERT', 'DUPLICATE', ' UNITS', ' BOND', 'BONUS RIGHTS', 'REAL ESTATE IFCA', 
-             'PROPERTY FUND', ' MIXED', ' REIT', 'COMMERCIAL FUND', ' DRC'], 
-            
-            'TURKEY':
-            ['CERT', ' NRFD', 'NIL PAID', 'FULLY PAID'], 
-            
-            'UNITED KINGDOM':
-            [' FUND ', ' TRUST ', 'NIL PAID', 'STOCK UNIT', 'ANNUITY UNIT', 'UNIT £', 
-             'UNIT TRUST', ' UNITS', ' ZDP ', 'REIT', 'POST RED', 'DEPOSITARY', ' RECEIPT', 
-             'INTERIM SHARES', 'REEDEMABLE', 'PREFERENCE', 'INVESTMENT TRUST', ' ADR',
-             'FULLY PAID', 'PARTLY PAID', ' BDR', ' NRDF', 'DEFERRED'], 
-            
-            'UKRAINE':
-            [' CF ', ' FUND', ' CLOSED FUND '] 
-            
-        }
 
         if country not in equity_identifers:
             raise ValueError(f"Invalid country: '{country}'. Must be one of {list(equity_identifers.keys())}.")
         
-        equity_identifer = equity_identifers[country]
-        equity_identifer = [re.escape(p) for p in equity_identifer]
+        patterns         = equity_identifers[country]
+
+        # the masks are combined as plain NumPy arrays (statics rows in order), without index alignment
+        is_ord           = statics["TRAC"].isin(["ORD", "ORDSUBR", "FULLPAID", "UKNOWN", "UNKNOW", "KNOW"]).to_numpy()
 
-        is_ord           = statics["TRAC"].isin(["ORD", "ORDSUBR", "FULLPAID", "UKNOWN", "UNKNOW", "KNOW"])
+        # ordinary shares are kept whatever their name contains, only the names of the other stocks are scanned
+        other_names      = statics.loc[~is_ord, "ENAME"]
 
-        if equity_identifer:
-            pattern_regex = "|".join([re.escape(p) for p in equity_identifer])
-            ename_condition = statics["ENAME"].str.contains(pattern_regex, case=True, na=False)
+        if len(patterns) > max_literal_scans:
+            ename_condition = contains_pattern(other_names, equity_identifer_patterns[country]).to_numpy()
+        elif patterns:
+            ename_condition = contains_literals(other_names, patterns).to_numpy()
         else:
-            ename_condition = False  # i.e., no additional exclusion via name patterns
+            ename_condition = np.zeros(len(other_names), dtype=bool)  # i.e., no additional exclusion via name patterns
 
-        keep_condition   = is_ord | (~ename_condition) # | = or operator
+        keep_condition   = is_ord.copy()  # is_ord or not ename_condition
+        keep_condition[~is_ord] = ~ename_condition
 
-        statics_filtered = statics[keep_condition].copy()
+        statics_filtered = statics[keep_condition]
         remaining_stocks = statics_filtered.DSCD.unique()
 
         removal_percentage = round(1 - keep_condition.sum() / statics.shape[0], 2)
         logging.info(f"For {country}, filter (1) removes ~{removal_percentage * 100}% of stocks (based on raw data).")
 
-        panel_filtered = panel[panel["Stock"].isin(remaining_stocks)].copy()
+        panel_filtered = panel[in_stocks(panel["Stock"], remaining_stocks)]
 
         return panel_filtered.reset_index(drop=True)
 
@@ -353,150 +1242,21 @@ class DSPreprocess:
             pd.DataFrame: The filtered panel dataset.
         """
                              
-        cross_listings_dict = {
-            'UNITED STATES':
-            r"\(NYS\)|\(NAS\)|\(ASE\)|\(OTC\)|\(XSQ\)|\(XQB\)",
-
-            'CANADA':
-            r"\(TSX\)|\(VSE\)|\(MON\)|\(TSE\)|\(TOR\)",
-            
-            'AUSTRIA':
-            r"\(WBO\)", 
-            
-            'AZERBAIJAN':
-            r"", 
-            
-            'BELGIUM':
-           r"\(BRU\)", 
-            
-            'BOSNIA AND HERZEGOVINA':
-            r"", 
-            
-            'BULGARIA':
-            r"", 
-            
-            'CROATIA':
-            r"", 
-            
-            'CZECH REPUBLIC':
-            r"\(PRA\)", 
-            
-            'CYPRUS':
-            r"\(CYP\)", 
-            
-            'DENMARK':
-            r"\(CSE\)", 
-            
-            'ESTONIA':
-            r"", 
-            
-            'FINLAND':
-            r"\(HEL\)", 
-            
-            'FRANCE':
-            r"\(PAR\)",
-            
-            'GERMANY':
-            r"\(FRA\)|\(STU\)|\(HAM\)|\(DUS\)|\(MUN\)|\(XET\)", 
-            
-            'GREECE':
-            r"\(ATH\)", 
-            
-            'HUNGARY':
-            r"\(BUD\)", 
-            
-            'ICELAND':
-            r"\(ICE\)", 
-            
-            'IRELAND':
-            r"\(DUB\)|\(IEX\)|\(ESM\)", 
-            
-            'ITALY':
-            r"\(MIL\)", 
-            
-            'KAZAKHSTAN':
-            r"\(KAZ\)", 
-            
-            'LATVIA':
-            r"", 
-            
-            'LITHUANIA':
-            r"", 
-            
-            'LUXEMBOURG':
-            r"\(LUX\)", 
-            
-            'NORTH MACEDONIA':
-            r"", 
-            
-            'MALTA':
-            r"\(MALTA\)|\(MAL.\)", 
-            
-            'MONTENEGRO':
-            r"", 
-            
-            'NETHERLANDS':
-            r"\(AMS\)|\(FL\)", 
-            
-            'NORWAY':
-            r"\(OSL\)", 
-            
-            'POLAND':
-            r"\(WAR\)", 
-            
-            'PORTUGAL':
-            r"\(LIS\)", 
-            
-            'ROMANIA':
-            r"\(BSE\)", 
-            
-            'RUSSIAN FEDERATION':
-            r"", 
-            
-            'SERBIA':
-            r"", 
-            
-            'SLOVAKIA':
-            r"", 
-            
-            'SLOVENIA':
-            r"", 
-            
-            'SPAIN':
-            r"\(MAD\)", 
-            
-            'SWEDEN':
-            r"\(OME\)|\(XSQ\)", 
-            
-            'SWITZERLAND':
-            r"\(SWX\)|\(BRN\)", 
-            
-            'TURKEY':
-            r"\(IST\)", 
-            
-            'UNITED KINGDOM':
-            r"\(LON\)|\(UNITED KINGDOM\)", 
-            
-            'UKRAINE':
-            r"" 
-            
-        }
-                             
         if country not in cross_listings_dict:
             raise ValueError(f"Invalid country: '{country}'. Must be one of {list(cross_listings_dict.keys())}.")
                              
         cross_listings     = cross_listings_dict[country]
 
         if cross_listings.strip(): # only filter if there's a non-empty pattern
-            statics_f2 = statics[~statics["ENAME"].str.contains(cross_listings, case=True, na=False)]
+            statics_f2 = statics[~contains_pattern(statics["ENAME"], cross_listings)]
         else:
-            statics_f2 = statics.copy()
+            statics_f2 = statics
 
         removal_percentage = round(1 - statics_f2.shape[0] / statics.shape[0], 3)
 
         logging.info(f"For {country}, filter (2) removes ~{removal_percentage * 100}% of stocks (based on raw data).")
         rem_stocks_f2  = statics_f2["DSCD"].unique()
-        panel_filtered = panel[panel["Stock"].isin(rem_stocks_f2)].copy()
+        panel_filtered = panel[in_stocks(panel["Stock"], rem_stocks_f2)]
 
         return panel_filtered.reset_index(drop=True)
 
@@ -518,16 +1278,18 @@ class DSPreprocess:
         Returns:
             pd.DataFrame: The filtered panel dataset.
         """
-        loc_size     = statics.groupby("LOC")["LOC"].transform("size") # Compute number of rows for each local code
-        has_p        = statics.groupby("LOC")["ISINID"].transform(lambda x: (x == "P").any()) # Create boolean mask that is true if ISINID == "P"
-        rows_to_keep = ~((loc_size > 1) & (has_p) & (statics["ISINID"] != "P"))
+        is_p         = statics["ISINID"] == "P"
+        loc_groups   = is_p.groupby(statics["LOC"], sort=False) # one grouping of the local codes for both transforms
+        loc_size     = loc_groups.transform("size") # Compute number of rows for each local code
+        has_p        = loc_groups.transform("any")  # Create boolean mask that is true if ISINID == "P" for any row of the local code
+        rows_to_keep = ~((loc_size.to_numpy() > 1) & has_p.to_numpy() & ~is_p.to_numpy())
 
-        statics_f3   = statics[rows_to_keep].copy()
+        statics_f3   = statics[rows_to_keep]
         removal_percentage = round(1 - statics_f3.shape[0] / statics.shape[0], 3)
         logging.info(f"Filter (3) removes ~{removal_percentage * 100}% of stocks (based on raw data).")
 
         rem_stocks_f3  = statics_f3["DSCD"].unique()
-        panel_filtered = panel[panel["Stock"].isin(rem_stocks_f3)].copy()
+        panel_filtered = panel[in_stocks(panel["Stock"], rem_stocks_f3)]
 
         return panel_filtered.reset_index(drop=True)
 
@@ -547,145 +1309,15 @@ class DSPreprocess:
             pd.DataFrame: The filtered panel dataset.
         """
         
-        country_codes_dict = {
-            
-            'USA': 
-            "UNITED STATES",
-
-            'Canada':
-            "CANADA",
-            
-            'Austria':
-            "AUSTRIA", 
-            
-            'Azerbaijan':
-            "AZERBAIJAN", 
-            
-            'Belgium':
-            "BELGIUM", 
-            
-            'Bosnia-Herzegovina':
-            "BOSNIA AND HERZEGOVINA", 
-            
-            'Bulgaria':
-            "BULGARIA", 
-            
-            'Croatia':
-            "CROATIA", 
-            
-            'Czech Republic':
-            "CZECH REPUBLIC", 
-            
-            'Cyprus':
-            "CYPRUS", 
-            
-            'Denmark':
-            "DENMARK", 
-            
-            'Estonia':
-            "ESTONIA", 
-            
-            'Finland':
-            "FINLAND", 
-            
-            'France':
-            "FRANCE",
-            
-            'Germany':
-            "GERMANY", 
-            
-            'Greece':
-            "GREECE", 
-            
-            'Hungary':
-            "HUNGARY", 
-            
-            'Iceland':
-            "ICELAND", 
-            
-            'Ireland':
-            "IRELAND", 
-            
-            'Italy':
-            "ITALY", 
-            
-            'Kazakhstan':
-            "KAZAKHSTAN", 
-            
-            'Latvia':
-            "LATVIA", 
-            
-            'Lithuania':
-            "LITHUANIA", 
-            
-            'Luxembourg':
-            "LUXEMBOURG", 
-            
-            'Macedonia':
-            "MACEDONIA", 
-            
-            'Malta':
-            "MALTA", 
-            
-            'Montenegro':
-            "MONTENEGRO", 
-            
-            'Netherlands':
-            "NETHERLANDS", 
-            
-            'Norway':
-            "NORWAY", 
-            
-            'Poland':
-            "POLAND", 
-            
-            'Portugal':
-            "PORTUGAL", 
-            
-            'Romania':
-            "ROMANIA", 
-            
-            'Russia':
-            "RUSSIAN FEDERATION", 
-            
-            'Serbia':
-            "SERBIA", 
-            
-            'Slovakia':
-            "SLOVAKIA", 
-            
-            'Slovenia':
-            "SLOVENIA", 
-            
-            'Spain':
-            "SPAIN", 
-            
-            'Sweden':
-            "SWEDEN", 
-            
-            'Switzerland':
-            "SWITZERLAND", 
-            
-            'Turkey':
-            "TURKEY", 
-            
-            'UK':
-            "UNITED KINGDOM", 
-            
-            'Ukraine':
-            "UKRAINE" 
-            
-        }
-        
         if country not in country_codes_dict:
             raise ValueError(f"Invalid country: '{country}'. Must be one of {list(country_codes_dict.keys())}.")
                                                                            
         country_code = country_codes_dict[country]
         
-        statics_f4 = statics[statics["GEOGN"] == country_code].copy()
+        statics_f4 = statics[statics["GEOGN"] == country_code]
 
         rem_stocks_f4  = statics_f4["DSCD"].unique()
-        panel_filtered = panel[panel["Stock"].isin(rem_stocks_f4)].copy()
+        panel_filtered = panel[in_stocks(panel["Stock"], rem_stocks_f4)]
 
         removal_percentage = round(1 - statics_f4.shape[0] / statics.shape[0], 4)
         logging.info(f"Filter (4) removes ~{removal_percentage * 100}% of stocks")
@@ -707,66 +1339,23 @@ class DSPreprocess:
             pd.DataFrame: The filtered panel dataset (only rows on or after the earliest start date).
         """
 
-        # Dictionary: country -> earliest allowable date (DD-MM-YYYY)
-        country_start_dates = {
-            'UNITED STATES': '31-12-1984',
-            'CANADA': '31-12-1983',
-            'AUSTRIA': '31-12-1991',
-            'AZERBAIJAN': '31-12-1900',
-            'BELGIUM': '31-12-1991',
-            'BOSNIA AND HERZEGOVINA': '31-12-2009',
-            'BULGARIA': '31-12-2005',
-            'CROATIA': '31-12-2005',
-            'CZECH REPUBLIC': '31-12-1995',
-            'CYPRUS': '31-12-2009',
-            'DENMARK': '31-12-1987',
-            'ESTONIA': '31-12-2009',
-            'FINLAND': '31-12-1987',
-            'FRANCE': '31-12-1981',
-            'GERMANY': '31-12-1988',
-            'GREECE': '31-12-1995',
-            'HUNGARY': '31-12-1999',
-            'ICELAND': '31-12-2005',
-            'IRELAND': '31-12-1989',
-            'ITALY': '31-12-1988',
-            'KAZAKHSTAN': '31-12-2013',
-            'LATVIA': '31-12-2009',
-            'LITHUANIA': '31-12-2007',
-            'LUXEMBOURG': '31-12-1994',
-            'NORTH MACEDONIA': '31-12-2009',
-            'MALTA': '31-03-2004',
-            'MONTENEGRO': '31-12-2012',
-            'NETHERLANDS': '31-12-1986',
-            'NORWAY': '31-12-1986',
-            'POLAND': '31-12-1995',
-            'PORTUGAL': '31-12-1991',
-            'ROMANIA': '31-12-2008',
-            'RUSSIAN FEDERATION': '31-12-2004',
-            'SERBIA': '31-12-2009',
-            'SLOVAKIA': '31-12-2007',
-            'SLOVENIA': '31-12-2005',
-            'SPAIN': '31-12-1992',
-            'SWEDEN': '31-12-1986',
-            'SWITZERLAND': '31-12-1982',
-            'TURKEY': '31-12-1994',
-            'UNITED KINGDOM': '31-12-1984',
-            'UKRAINE': '31-12-2006',
-        }
-
         if country not in country_start_dates:
             raise ValueError(
                 f"Invalid country: '{country}'. Must be one of {list(country_start_dates.keys())}."
             )
 
-        # Convert the string to a proper datetime object; note dayfirst=True or format='%d-%m-%Y'
-        earliest_date = pd.to_datetime(country_start_dates[country], dayfirst=True)
+        # datetime64 scalar parsed at import, the dates of the panel are already datetime64[ns] (see prepare)
+        earliest_date = country_start_datetimes[country]
 
         # Filter statics down to the stocks belonging to the specified country
-        country_statics = statics[statics["GEOGN"] == country].copy()
+        country_statics = statics[statics["GEOGN"] == country]
         country_stocks  = country_statics["DSCD"].unique()
-        panel_country   = panel[panel["Stock"].isin(country_stocks)].copy()
-        panel_country["Date"] = pd.to_datetime(panel_country["Date"])
-        panel_filtered = panel_country[panel_country["Date"] >= earliest_date].copy()
+        panel_country   = panel[in_stocks(panel["Stock"], country_stocks)]
+        # the panel comes in date order from the import, then the kept rows are one slice found by binary search
+        if panel_country["Date"].is_monotonic_increasing:
+            panel_filtered = panel_country.iloc[panel_country["Date"].searchsorted(earliest_date, side='left'):]
+        else:
+            panel_filtered = panel_country[panel_country["Date"].to_numpy() >= earliest_date]
 
         original_count = len(panel_country)
         filtered_count = len(panel_filtered)
@@ -792,148 +1381,19 @@ class DSPreprocess:
             pd.DataFrame: The filtered panel dataset.
         """
         
-        currencies_dict = {
-            
-            'UNITED STATES':
-            ['U$'],
-
-            'CANADA':
-            ['C$'],
-            
-            'AUSTRIA':
-            ['AS', 'E'], 
-            
-            'AZERBAIJAN':
-            ['AM'], 
-            
-            'BELGIUM':
-            ['BF', 'E'], 
-            
-            'BOSNIA AND HERZEGOVINA':
-            ['BO'], 
-            
-            'BULGARIA':
-            ['BL'], 
-            
-            'CROATIA':
-            ['KA', 'E'],
-            
-            'CZECH REPUBLIC':
-            ['CK', 'E'],
-            
-            'CYPRUS':
-            ['CY', 'E'],
-            
-            'DENMARK':
-            ['DK'],
-            
-            'ESTONIA':
-            ['EK', 'E'], 
-            
-            'FINLAND':
-            ['M', 'E'], 
-            
-            'FRANCE':
-            ['FF', 'E'],
-            
-            'GERMANY':
-            ['DM', 'E'], 
-            
-            'GREECE':
-            ['DR', 'E'], 
-            
-            'HUNGARY':
-            ['HF'], 
-            
-            'ICELAND':
-            ['IK'], 
-            
-            'IRELAND':
-            ['£E', 'E'],
-            
-            'ITALY':
-            ['L', 'E'], 
-            
-            'KAZAKHSTAN':
-            ['KT'],
-            
-            'LATVIA':
-            ['LV', 'E'],
-            
-            'LITHUANIA':
-            ['LT', 'E'],
-            
-            'LUXEMBOURG':
-            ['LF', 'E'],
-            
-            'NORTH MACEDONIA':
-            ['MC'],
-            
-            'MALTA':
-            ['M£', 'E'],
-            
-            'MONTENEGRO':
-            ['E'],
-            
-            'NETHERLANDS':
-            ['FL', 'E'],
-            
-            'NORWAY':
-            ['NK'],
-            
-            'POLAND':
-            ['PZ'],
-            
-            'PORTUGAL':
-            ['PE', 'E'],
-            
-            'ROMANIA':
-            ['RL'],
-            
-            'RUSSIAN FEDERATION':
-            ['UR', 'U$'],
-            
-            'SERBIA':
-            ['YD'],
-            
-            'SLOVAKIA':
-            ['KK', 'E'],
-            
-            'SLOVENIA':
-            ['TO', 'E'],
-            
-            'SPAIN':
-            ['EP', 'E'],
-            
-            'SWEDEN':
-            ['SK'],
-            
-            'SWITZERLAND':
-            ['SF'],
-            
-            'TURKEY':
-            ['TL'],
-            
-            'UNITED KINGDOM':
-            ['£'],
-            
-            'UKRAINE':
-            ['KB']
-                 
-       }                      
-        
         if country not in currencies_dict:
             raise ValueError(f"Invalid country: '{country}'. Must be one of {list(currencies_dict.keys())}.")                     
                              
         currency = currencies_dict[country]                  
                              
         # statics_f5 = statics[statics["PCUR"].isin(currency)].copy()
-        statics_f5 = statics[(statics["PCUR"].isin(currency)) & (statics["GEOGN"] == country)].copy()
+        in_country = (statics["GEOGN"] == country).to_numpy()
+        statics_f5 = statics[statics["PCUR"].isin(currency).to_numpy() & in_country]
 
         rem_stocks_f5  = statics_f5["DSCD"].unique()
-        panel_filtered = panel[panel["Stock"].isin(rem_stocks_f5)].copy()
+        panel_filtered = panel[in_stocks(panel["Stock"], rem_stocks_f5)]
 
-        removal_percentage = round(1 - statics_f5.shape[0] / statics[statics["GEOGN"] == country].shape[0], 3)
+        removal_percentage = round(1 - statics_f5.shape[0] / in_country.sum(), 3)
         logging.info(f"For {country}, filter (5) removes ~{removal_percentage * 100}% of stocks")
 
         return panel_filtered.reset_index(drop=True)
@@ -952,14 +1412,10 @@ class DSPreprocess:
         Returns:
             Tuple[pd.DataFrame, pd.DataFrame]: Filtered OHLCV_panel and statics dataframes.
         """
-        stock_country = OHLCV_panel[['Stock']].drop_duplicates().merge(
-            statics[['DSCD', 'GEOGN']],
-            left_on='Stock',
-            right_on='DSCD',
-            how='left'
-        )
-
-        country_counts    = stock_country.groupby('GEOGN')['Stock'].nunique()
+        # the statics rows of the stocks in the panel, a lookup over the stock codes instead of joining the panel stocks
+        stock_country     = statics.loc[in_stocks(statics['DSCD'], OHLCV_panel['Stock'].unique()), ['DSCD', 'GEOGN']]
+
+        country_counts    = stock_country.groupby('GEOGN', observed=True)['DSCD'].nunique()
         removed_countries = country_counts[country_counts < min_stocks]
         valid_countries   = country_counts[country_counts >= min_stocks].index
 
@@ -971,9 +1427,9 @@ class DSPreprocess:
         else:
             logging.info("\nNo countries removed — all meet the minimum stock threshold.")
 
-        statics_filtered     = statics[statics['GEOGN'].isin(valid_countries)].copy()
+        statics_filtered     = statics[statics['GEOGN'].isin(valid_countries)]
         valid_stocks         = statics_filtered['DSCD'].unique()
-        OHLCV_panel_filtered = OHLCV_panel[OHLCV_panel['Stock'].isin(valid_stocks)].copy()
+        OHLCV_panel_filtered = OHLCV_panel[in_stocks(OHLCV_panel['Stock'], valid_stocks)]
 
         return OHLCV_panel_filtered, statics_filtered
 
@@ -991,24 +1447,20 @@ class DSPreprocess:
         Returns:
             pd.DataFrame: The filtered panel dataset.
         """
-        panel = panel.copy()
-
-        def check_implausibility(x):
-            x = x.dropna()
-            nonzero = x[x != 0]
-            if len(nonzero) == 0:
-                return False
-
-            pos_fraction = (nonzero > 0.0).mean()
-            neg_fraction = (nonzero < 0.0).mean()
+        # count the positive and negative returns of every stock in one pass, missings count as neither
+        stock_codes, order, bounds = stock_groups(panel)
+        counts, _ = stock_return_stats(panel["Return"].to_numpy(dtype=np.float64), order, bounds)
+        positive, negative = counts[:, 1], counts[:, 2]
+        nonzero            = positive + negative
 
-            # If more than 98% of nonzero returns are all positive or all negative, flag as implausible.
-            return pos_fraction > 0.98 or neg_fraction > 0.98
+        with np.errstate(invalid="ignore", divide="ignore"):
+            pos_fraction = positive / nonzero
+            neg_fraction = negative / nonzero
 
-        stock_implausible  = panel.groupby("Stock")["Return"].apply(check_implausibility)
-        stocks_implausible = stock_implausible[stock_implausible].index
+        # If more than 98% of nonzero returns are all positive or all negative, flag as implausible (stocks without nonzero returns are kept).
+        stock_implausible  = (nonzero > 0) & ((pos_fraction > 0.98) | (neg_fraction > 0.98))
 
-        panel_filtered     = panel[~panel["Stock"].isin(stocks_implausible)].copy()
+        panel_filtered     = panel[~stock_implausible[stock_codes]]
         removal_percentage = round(1 - panel_filtered.shape[0] / panel.shape[0], 3)
         logging.info(f"Filter (7) removes ~{removal_percentage * 100}% of observations")
 
@@ -1032,33 +1484,24 @@ class DSPreprocess:
 
         statics_unique = statics.drop_duplicates(subset="DSCD", keep="first")
 
-        panel_merged = panel.merge(
-            statics_unique[["DSCD", "Delisting Date"]],
-            how="inner",
-            left_on="Stock",
-            right_on="DSCD"
-        )
-
-        def truncate_at_delisting(df):
-            df = df.sort_values("Date")
-            delist_date = df["Delisting Date"].iloc[0]
-            if pd.notna(delist_date):
-                df = df[df["Date"] <= delist_date].copy()
-                row_idx = df.index
-                ret_vals = df["Return"].values
-                rows_to_remove = []
-                for i in range(len(ret_vals) - 1, -1, -1):
-                    if (ret_vals[i] == 0) or pd.isna(ret_vals[i]):
-                        rows_to_remove.append(row_idx[i])
-                    else:
-                        break
-                df.drop(index=rows_to_remove, inplace=True)
-            else:
-                df = df.copy()
-            return df
-
-        panel_filtered = panel_merged.groupby("Stock", group_keys=False)[panel_merged.columns].apply(
-            truncate_at_delisting)
+        # inner join with the statics as a lookup of the (unique) stock codes, the panel is selected once instead of being merged
+        delisting_dates = statics_unique.set_index("DSCD")["Delisting Date"]
+        positions       = delisting_dates.index.get_indexer(panel["Stock"])
+        in_statics      = positions >= 0
+        panel_merged    = panel[in_statics]
+        panel_merged    = panel_merged.assign(**{
+            "DSCD":           panel_merged["Stock"],
+            "Delisting Date": delisting_dates.to_numpy()[positions[in_statics]],
+        })
+
+        # per stock in date order: drop everything after the delisting date and the zero / missing returns padded before it
+        panel_merged = sort_by_stock_date(panel_merged)
+        no_date      = np.iinfo(np.int64).min  # NaT
+        keep         = delisting_mask(panel_merged["Date"].to_numpy(dtype="datetime64[ns]").view(np.int64),
+                                      panel_merged["Return"].to_numpy(dtype=np.float64),
+                                      panel_merged["Delisting Date"].to_numpy(dtype="datetime64[ns]").view(np.int64),
+                                      stock_bounds(panel_merged), no_date)
+        panel_filtered = panel_merged[keep]
 
         removal_percentage = round(1 - panel_filtered.shape[0] / panel.shape[0], 3)
         logging.info(f"Filter (13) removes ~{removal_percentage * 100}% of observations")
@@ -1080,25 +1523,19 @@ class DSPreprocess:
             DataFrame: The filtered panel DataFrame.
         """
 
-        def filter_stale_prices_for_stock(df):
-            df     = df.sort_values("Date").copy()
-            prices = df["ReturnIndex"].values
-            keep   = [True] * len(df)
-
-            current_run = 1
-            for i in range(1, len(prices)):
-                if prices[i] == prices[i - 1]:
-                    current_run += 1  # Increment the run if the same price repeats
-                else:
-                    current_run = 1   # Reset the run when a new price is encountered
-
-                if current_run > 30:
-                    keep[i] = False   # Mark the row to be dropped if repetition exceeds 30 days
-
-            return df[keep].copy()
-
+        # per stock in date order: drop every observation that repeats the same price for more than 30 days.
+        # Only the key columns are sorted, the kernel walks the prices through the sort order and marks the rows in place,
+        # so that the panel is selected once in its own row order instead of being reordered first
         original_count = panel.shape[0]
-        panel_filtered = panel.groupby("Stock", group_keys=False)[panel.columns].apply(filter_stale_prices_for_stock)
+        stock_codes    = pd.factorize(panel["Stock"])[0]
+        if is_sorted_by_stock_date(panel):
+            order = np.arange(original_count)
+        else:
+            order = np.lexsort((panel["Date"].to_numpy(), stock_codes))
+        sorted_codes   = stock_codes[order]
+        bounds         = np.append(np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]), original_count)
+        keep           = stale_price_mask(panel["ReturnIndex"].to_numpy(dtype=np.float64), order, bounds, 30)
+        panel_filtered = panel[keep]
 
         removal_percentage = round(1 - panel_filtered.shape[0] / original_count, 5)
         logging.info(f"Filter (14) removes ~{removal_percentage * 100}% of observations")
@@ -1118,12 +1555,13 @@ class DSPreprocess:
         Returns:
             pd.DataFrame: Filtered DataFrame excluding stocks with excessive zero returns.
         """
-        # Compute fraction of zero returns per stock
-        frac_zero = panel.groupby("Stock")["Return"].apply(lambda x: (x == 0.0).mean())
+        # Compute fraction of zero returns per stock, missing returns count as nonzero observations
+        stock_codes, order, bounds = stock_groups(panel)
+        counts, _ = stock_return_stats(panel["Return"].to_numpy(dtype=np.float64), order, bounds)
+        frac_zero = counts[:, 3] / np.diff(bounds)
 
-        # Identify and remove stocks with more than 95% zeros
-        stocks_too_many_zeros = frac_zero[frac_zero > 0.95].index
-        panel_filtered = panel[~panel["Stock"].isin(stocks_too_many_zeros)].copy()
+        # Identify and remove stocks with more than 95% zeros, the fraction of its stock is looked up for every row
+        panel_filtered = panel[~(frac_zero[stock_codes] > 0.95)]
 
         removed_percentage = round(1 - panel_filtered.shape[0] / panel.shape[0], 6)
         logging.info(f"Filter (8) removes ~{removed_percentage * 100}% of observations")
@@ -1144,10 +1582,10 @@ class DSPreprocess:
             pd.DataFrame: A copy of the input panel with stocks exceeding the volatility threshold removed.
         """
 
-        std_returns = panel.groupby("Stock")["Return"].std().dropna()
+        std_returns = panel.groupby("Stock", observed=True)["Return"].std().dropna()
         stocks_to_filter = std_returns[std_returns > volatility_threshold].index
 
-        panel_filtered = panel[~panel["Stock"].isin(stocks_to_filter)].copy()
+        panel_filtered = panel[~in_stocks(panel["Stock"], stocks_to_filter)]
         removed_percentage = round(1 - panel_filtered.shape[0] / panel.shape[0], 3)
         logging.info(f"Filter (9) removes ~{removed_percentage * 100}% of observations")
 
@@ -1167,15 +1605,43 @@ class DSPreprocess:
         Returns:
             pd.DataFrame: A copy of the input panel with stocks having low volatility removed.
         """
-        std_returns      = panel.groupby("Stock")["Return"].std().dropna()
+        std_returns      = panel.groupby("Stock", observed=True)["Return"].std().dropna()
         low_vol_stocks   = std_returns[std_returns < low_threshold].index
 
-        panel_filtered   = panel[~panel["Stock"].isin(low_vol_stocks)].copy()
+        panel_filtered   = panel[~in_stocks(panel["Stock"], low_vol_stocks)]
         removed_fraction = 1 - panel_filtered.shape[0] / panel.shape[0]
         logging.info(f"Filter (10) removes ~{round(removed_fraction * 100, 6)}% of observations")
 
         return panel_filtered.reset_index(drop=True)
 
+    @staticmethod
+    def filter_stocks_by_volatility(panel, volatility_threshold=0.4, low_threshold=1e-6):
+        """
+        Applies filter (9) and filter (10) from Landis & Skouras (2021) with a single computation of the daily standard deviations.
+        Both filters only depend on the standard deviation of each stock, so the result equals filter_stocks_by_high_volatility
+        followed by filter_stocks_by_low_volatility.
+
+        Parameters:
+            panel (pd.DataFrame): DataFrame containing at least the columns 'Stock' and 'Return'.
+            volatility_threshold (float): Maximum allowed daily standard deviation (default is 0.4, i.e., 40%).
+            low_threshold (float): The minimum allowed daily standard deviation (default 1e-6).
+
+        Returns:
+            pd.DataFrame: The input panel without stocks with a very high or a very low volatility.
+        """
+        # one std per stock broadcast to the rows, both thresholds are compared on it (stocks without std are kept)
+        stock_codes, order, bounds = stock_groups(panel)
+        _, std = stock_return_stats(panel["Return"].to_numpy(dtype=np.float64), order, bounds)
+        std_returns = std[stock_codes]
+        high_vol    = std_returns > volatility_threshold
+        low_vol     = std_returns < low_threshold
+
+        n_high, n_low = high_vol.sum(), low_vol.sum()
+        logging.info(f"Filter (9) removes ~{round(n_high / panel.shape[0], 3) * 100}% of observations")
+        logging.info(f"Filter (10) removes ~{round(n_low / (panel.shape[0] - n_high) * 100, 6)}% of observations")
+
+        return panel[~(high_vol | low_vol)].reset_index(drop=True)
+
     @staticmethod
     def filter_short_history_stocks(panel, threshold=120):
         """
@@ -1194,19 +1660,19 @@ class DSPreprocess:
         Returns:
         - pd.DataFrame: The filtered panel.
         """
-        panel['Date'] = pd.to_datetime(panel['Date'])
+        if not pd.api.types.is_datetime64_any_dtype(panel['Date']):  # dates already come as datetime64[ns] from prepare
+            panel['Date'] = pd.to_datetime(panel['Date'])
         overall_last_date = panel['Date'].max()
 
-        def stock_filter(group):
-            num_obs = group.shape[0]  # total observations for the stock
-            first_date = group['Date'].min()  # first observation date for the stock
+        # native per-stock transforms instead of a Python callback per group
+        stock_dates = panel.groupby('Stock', observed=True)['Date']
+        num_obs     = stock_dates.transform('size')  # total observations for the stock
+        first_date  = stock_dates.transform('min')   # first observation date for the stock
 
-            if (overall_last_date - first_date).days < threshold:
-                return True  # True if short horizon is at the end of the dataset.
-            else:
-                return num_obs >= threshold  # Returns False if there are less observations than "threshold".
+        # keep stocks whose short horizon is at the end of the dataset or that have at least "threshold" observations
+        keep_stock = ((overall_last_date - first_date).dt.days < threshold) | (num_obs >= threshold)
 
-        panel_filtered   = panel.groupby('Stock').filter(stock_filter)
+        panel_filtered   = panel[keep_stock.to_numpy()]
         removed_fraction = 1 - panel_filtered.shape[0] / panel.shape[0]
         logging.info(f"Filter (12) removes ~{round(removed_fraction * 100, 6)}% of observations")
 
@@ -1234,24 +1700,15 @@ class DSPreprocess:
         if method not in ["drop", "zero"]:
             raise ValueError("The method parameter must be either 'drop' or 'zero'.")
 
-        def filter_stock(group, method = method):
-            group = group.sort_values('Date').reset_index(drop=True)
-            ret = group['Return']
-
-            # Define error conditions:
-            cond1 = (ret > up_ts) & (ret.shift(-1) < down_ts)
-            cond2 = (ret < down_ts) & (ret.shift(-1) > up_ts)
-            outlier = cond1 | cond2  # | = OR condition. Mark as outlier if either condition is met
-
-            to_replace = outlier | outlier.shift(1, fill_value=False)  # Shift outlier mask by one to also mark the second day.
-
-            if method == 'drop':
-                group = group[~to_replace]
-            else:
-                group.loc[to_replace, 'Return'] = 0
-            return group
+        # one pass over the panel in (Stock, Date) order, the next day's return is only taken from the same stock.
+        # Both days of an outlier are marked: a jump above up_ts reversed below down_ts the next day, or vice versa
+        panel_sorted = sort_by_stock_date(panel)
+        to_replace   = outlier_mask(panel_sorted['Return'].to_numpy(dtype=np.float64), stock_bounds(panel_sorted), up_ts, down_ts)
 
-        panel_filtered = panel.groupby('Stock', group_keys=False)[panel.columns].apply(filter_stock)
+        if method == 'drop':
+            panel_filtered = panel_sorted[~to_replace]
+        else:
+            panel_filtered = panel_sorted.assign(Return=np.where(to_replace, 0.0, panel_sorted['Return']))
 
         removed_fraction = 1 - panel_filtered.shape[0] / panel.shape[0]
         logging.info(f"Filter (15) removes ~{round(removed_fraction * 100, 5)}% of observations")
@@ -1277,13 +1734,13 @@ class DSPreprocess:
         # Total unique stocks in the panel.
         total_stocks = panel['Stock'].nunique()
 
-        # For each date, count stocks with non-missing and non-zero returns.
-        daily_active  = panel.groupby('Date')['Return'].apply(lambda x: (x.notna() & (x != 0.0)).sum())
+        # For each date, count stocks with non-missing and non-zero returns, a native grouped sum broadcast to the rows of the date.
+        active        = panel['Return'].notna() & (panel['Return'] != 0.0)
+        daily_active  = active.groupby(panel['Date'], sort=False).transform('sum').to_numpy()
 
         # Compute the fraction of active stocks per day.
         daily_fraction = daily_active / total_stocks
-        valid_dates    = daily_fraction[daily_fraction >= threshold].index
-        panel_filtered = panel[panel['Date'].isin(valid_dates)]
+        panel_filtered = panel[daily_fraction >= threshold]
 
         removed_fraction = 1 - panel_filtered.shape[0] / panel.shape[0]
         logging.info(f"Filter (16) removes ~{round(removed_fraction * 100, 3)}% of observations")
@@ -1309,38 +1766,59 @@ class DSPreprocess:
         Returns:
             pd.DataFrame: The filtered DataFrame with stocks removed based on the described criteria.
         """
-        panel = panel.copy()
-        panel['Date'] = pd.to_datetime(panel['Date'])
-        panel['Month'] = panel['Date'].dt.to_period('M')  # Extract month
-
-        # Compute the last trading day's unadjusted close for each stock in each month
-        monthly = (
-            panel.sort_values('Date')
-            .groupby(['Stock', 'Month'], as_index=False)
-            .last()[['Stock', 'Month', 'UnadjClose']]
-            .rename(columns={'UnadjClose': 'LastUnadjClose'})
-        )
+        panel = panel.copy(deep=False)  # the helper columns below are added to a new frame that shares the data of the caller's panel
+        if not pd.api.types.is_datetime64_any_dtype(panel['Date']):  # dates already come as datetime64[ns] from prepare
+            panel['Date'] = pd.to_datetime(panel['Date'])
+        # Extract month as plain datetime64 (first day of the month), grouped on its integer values instead of Period objects
+        months_of_rows = panel['Date'].to_numpy().astype('datetime64[M]')
+        panel['Month'] = months_of_rows
+
+        # One scan over the rows in (Stock, Date) order, the panel itself is not reordered: every stock-month is a run of rows,
+        # its last observed unadjusted close is the value of its last row with a close, and the previous month's close of a
+        # row is that value of the preceding run if the run belongs to the same stock.
+        stock_codes = pd.factorize(panel['Stock'])[0]
+        order       = np.lexsort((panel['Date'].to_numpy(), stock_codes))
+        stocks      = stock_codes[order]
+        months      = months_of_rows.view(np.int64)[order]
+        closes      = panel['UnadjClose'].to_numpy()[order]
+
+        run_starts  = np.r_[True, (stocks[1:] != stocks[:-1]) | (months[1:] != months[:-1])]
+        run_ids     = np.cumsum(run_starts) - 1
+        run_stocks  = stocks[run_starts]
+
+        # last unadjusted close of each stock-month (missing if the month has no close)
+        observed    = np.flatnonzero(~np.isnan(closes))
+        last_rows   = observed[np.r_[run_ids[observed][1:] != run_ids[observed][:-1], True]] if observed.size else observed
+        last_close  = np.full(run_stocks.size, np.nan, dtype=closes.dtype)
+        last_close[run_ids[last_rows]] = closes[last_rows]
 
         # For each stock, shift the last observed unadjusted close price
-        monthly['prev_UnadjClose'] = monthly.groupby('Stock')['LastUnadjClose'].shift(1)
+        prev_close  = np.full(run_stocks.size, np.nan, dtype=closes.dtype)
+        same_stock  = run_stocks[1:] == run_stocks[:-1]
+        prev_close[1:][same_stock] = last_close[:-1][same_stock]
 
-        # Merge the previous month's UnadjClose back into the original panel
-        panel = panel.merge(monthly[['Stock', 'Month', 'prev_UnadjClose']], on=['Stock', 'Month'], how='left')
+        # Bring the previous month's UnadjClose back to the rows of the panel
+        prev_unadj_close        = np.empty_like(closes)
+        prev_unadj_close[order] = prev_close[run_ids]
+        panel = panel.reset_index(drop=True).assign(prev_UnadjClose=prev_unadj_close)
 
         # For each month, compute the percentile of the previous month's UnadjClose, ignoring NA values
         quantile_string = f"q_{str(percentile)}"
-        panel[quantile_string] = panel.groupby('Month')['prev_UnadjClose'].transform(lambda x: x.quantile(percentile))
+        monthly_quantiles      = panel.groupby('Month')['prev_UnadjClose'].quantile(percentile)  # native grouped quantile, looked up per row
+        panel[quantile_string] = monthly_quantiles.reindex(panel['Month']).to_numpy()
 
         # Filter out stocks in month t if their previous month's UnadjClose is below the percentile.
         panel_filtered = panel[
             (panel['prev_UnadjClose'].isna()) | (panel['prev_UnadjClose'] >= panel[quantile_string])
-            ].copy()
+            ]
 
-        panel_filtered.drop(columns=['Month', quantile_string], inplace=True)
+        panel_filtered = panel_filtered.drop(columns=['Month', quantile_string])
 
         removed_fraction = 1 - panel_filtered.shape[0] / panel.shape[0]
         logging.info(f"Filter (21) removed ~{round(removed_fraction * 100, 4)}% of observations")
-        return panel_filtered, panel.groupby("Month")[quantile_string].mean()
+        # the monthly thresholds are reported per calendar month
+        monthly_thresholds = panel.groupby("Month")[quantile_string].mean()
+        return panel_filtered, monthly_thresholds.set_axis(monthly_thresholds.index.to_period('M'))
 
 
     @staticmethod
@@ -1358,10 +1836,12 @@ class DSPreprocess:
         Returns:
         - pd.DataFrame: The filtered panel with inconsistent rows removed.
         """
-        max_val = panel[['Open', 'Close', 'Low']].max(axis=1)
-        min_val = panel[['Open', 'Close', 'High']].min(axis=1)
+        # pairwise over the 1-D columns, fmax and fmin skip missing prices like the row-wise max and min of a frame
+        open_, high, low, close = (panel[column].to_numpy() for column in ['Open', 'High', 'Low', 'Close'])
+        max_val = np.fmax(np.fmax(open_, close), low)
+        min_val = np.fmin(np.fmin(open_, close), high)
 
-        valid_mask = ((panel['High'].isna() | (panel['High'] >= max_val)) & (panel['Low'].isna() | (panel['Low'] <= min_val)))
+        valid_mask = ((np.isnan(high) | (high >= max_val)) & (np.isnan(low) | (low <= min_val)))
 
         panel_filtered = panel[valid_mask]
 
@@ -1384,9 +1864,11 @@ class DSPreprocess:
          Returns:
              pd.DataFrame: Filtered DataFrame.
          """
-        condition = (panel[['Open', 'High', 'Low', 'Close']] <= ts) | (panel[['Open', 'High', 'Low', 'Close']].isna())
-        mask = condition.all(axis=1)
-        panel_filtered = panel[mask].copy()
+        mask = np.ones(panel.shape[0], dtype=bool)
+        for column in ['Open', 'High', 'Low', 'Close']:
+            prices = panel[column].to_numpy()
+            mask  &= (prices <= ts) | np.isnan(prices)
+        panel_filtered = panel[mask]
         removed_fraction = 1 - panel_filtered.shape[0] / panel.shape[0]
         logging.info(f"Extreme prices filter ~{round(removed_fraction * 100, 7)}% of observations")
 
@@ -1425,21 +1907,12 @@ class DSPreprocess:
             pd.DataFrame: Filtered DataFrame.
         """
 
-        def drop_identical(group):
-            group["High_prev"] = group["High"].shift(1)
-            group["Low_prev"] = group["Low"].shift(1)
-            group["Volume_prev"] = group["Volume"].shift(1)
-
-            group["drop"] = (
-                    (group["High"] == group["High_prev"]) &
-                    (group["Low"] == group["Low_prev"]) &
-                    (group["Volume"] == group["Volume_prev"])
-            )
-            group["drop"] = group["drop"].fillna(False)
-            group = group[~group["drop"]]
-            return group.drop(columns=["High_prev", "Low_prev", "Volume_prev", "drop"])
+        # the stocks one after the other in date order, each row is compared with the previous row of the same stock
+        panel_sorted = sort_by_stock_date(panel)
+        drop         = repeated_quotes_mask(panel_sorted["High"].to_numpy(), panel_sorted["Low"].to_numpy(),
+                                            panel_sorted["Volume"].to_numpy(), stock_bounds(panel_sorted))
 
-        panel_filtered = panel.groupby("Stock", group_keys=False)[panel.columns].apply(drop_identical)
+        panel_filtered = panel_sorted[~drop]
         removed_fraction = 1 - panel_filtered.shape[0] / panel.shape[0]
         logging.info(f"Identical HL&V filter removed ~{round(removed_fraction * 100, 7)}% of observations")
 
@@ -1460,10 +1933,12 @@ class DSPreprocess:
             pd.DataFrame: The filtered DataFrame containing only observations with 'Return'
                           between the lower and upper quantiles for each Date.
         """
-        lower_threshold = panel.groupby('Date')['Return'].transform(lambda x: x.quantile(lower))
-        upper_threshold = panel.groupby('Date')['Return'].transform(lambda x: x.quantile(upper))
+        # both daily quantiles from one native grouped quantile, looked up for the dates of the panel rows
+        daily_quantiles = panel.groupby('Date')['Return'].quantile([lower, upper]).unstack()
+        thresholds      = daily_quantiles.reindex(panel['Date']).to_numpy()
+        returns         = panel['Return'].to_numpy()
 
-        panel_filtered = panel[(panel['Return'] >= lower_threshold) & (panel['Return'] <= upper_threshold)].copy()
+        panel_filtered = panel[(returns >= thresholds[:, 0]) & (returns <= thresholds[:, 1])]
 
         removal_percentage = round(1 - panel_filtered.shape[0] / panel.shape[0], 3)
         logging.info(f"Outlier filter removes ~{removal_percentage * 100:.2f}% of observations")
@@ -1497,7 +1972,7 @@ class DSPreprocess:
         panel_filtered = panel[
             panel['Return'].isna() |
             ((panel['Return'] >= lower_threshold) & (panel['Return'] <= upper_threshold))
-            ].copy()
+            ]
 
         # Print how many observations were removed
         removal_percentage = 1 - panel_filtered.shape[0] / panel.shape[0]
@@ -1550,7 +2025,7 @@ class DSPreprocess:
         expected_UP     = panel['Close'] * panel['AdjFactor']
         diff_percentage = abs(panel['UnadjClose'] - expected_UP) / expected_UP
 
-        panel_filtered = panel[(diff_percentage <= threshold) | (diff_percentage.isna())].copy()
+        panel_filtered = panel[(diff_percentage <= threshold) | (diff_percentage.isna())]
 
         removal_percentage = round(1 - panel_filtered.shape[0] / panel.shape[0], 3)
         logging.info(f"Filter (18) removes ~{removal_percentage * 100:.2f}% of observations")